@@ -28,12 +28,19 @@ setup(
         'setuptools',
         'Flask',
     ],
+    extras_require={
+        'zstd': ['zstandard>=0.11'],
+        'msgpack': ['msgpack'],
+    },
     entry_points="""
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
-    import_xml_url = presence_analyzer.utils:import_user_xml_form_url
+    import_xml_url = presence_analyzer.script:import_users_xml
+    loadtest = presence_analyzer.loadtest:main
     [paste.app_factory]
     main = presence_analyzer.script:make_app
     debug = presence_analyzer.script:make_debug
+    [paste.server_runner]
+    prefork = presence_analyzer.server:prefork_server_runner
     """,
 )
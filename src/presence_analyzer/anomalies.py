@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Detection of unusual presence days against per-user weekday norms.
+"""
+from math import sqrt
+
+
+METRICS = ('presence', 'start', 'end')
+
+
+class RunningStats(object):
+    """
+    Running mean and variance of a stream of values (Welford's method).
+    """
+    __slots__ = ('count', 'mean', 'm2')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        """
+        Adds value to the stream.
+        """
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    @property
+    def std(self):
+        """
+        Sample standard deviation, 0 for less than two values.
+        """
+        if self.count < 2:
+            return 0.0
+        return sqrt(self.m2 / (self.count - 1))
+
+    def zscore(self, value):
+        """
+        Number of standard deviations value is away from the mean, None
+        when deviation is unknown or zero.
+        """
+        std = self.std
+        if not std:
+            return None
+        return (value - self.mean) / std
+
+
+class Norms(object):
+    """
+    Running statistics of daily presence, first arrival and last departure
+    of every user per weekday.
+
+    Statistics are updated in O(1) per presence day, so they are built in
+    a single pass over presence data, once per data generation.
+    """
+
+    def __init__(self):
+        self.stats = {}
+
+    def add(self, user_id, day, values):
+        """
+        Adds (presence, start, end) of given user and date.
+        """
+        key = user_id, day.weekday()
+        if key not in self.stats:
+            self.stats[key] = [RunningStats() for _ in METRICS]
+        for stats, value in zip(self.stats[key], values):
+            stats.add(value)
+
+    def check(self, user_id, day, values, threshold, min_days):
+        """
+        Yields (metric, value, mean, zscore) of values of given user and
+        date which are more than `threshold` standard deviations away
+        from the user's weekday norm. Norms built from less than
+        `min_days` days are not trusted.
+        """
+        norms = self.stats.get((user_id, day.weekday()))
+        if norms is None or norms[0].count < min_days:
+            return
+        for metric, stats, value in zip(METRICS, norms, values):
+            zscore = stats.zscore(value)
+            if zscore is not None and abs(zscore) >= threshold:
+                yield metric, value, stats.mean, zscore
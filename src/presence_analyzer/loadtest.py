@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+Load-test harness replaying a traffic profile against the application.
+
+Each concurrency level is measured twice: on freshly started instance
+(cold caches) and once more after that (warm caches). Throughput and
+latency percentiles of both runs are reported.
+"""
+import re
+import sys
+import json
+import math
+import time
+import random
+import urllib2
+import argparse
+import threading
+from functools import partial
+from collections import Counter
+
+
+DEFAULT_PROFILE = [
+    (10, '/api/v1/users'),
+    (10, '/api/v2/users'),
+    (25, '/api/v1/mean_time_weekday/{user_id}'),
+    (25, '/api/v1/presence_weekday/{user_id}'),
+    (25, '/api/v1/presence_start_end/{user_id}'),
+    (5, '/api/v2/user/{user_id}/dashboard'),
+]
+
+LOG_REQUEST = re.compile(r'"GET (\S+) HTTP/[0-9.]+"')
+
+
+def read_profile(path):
+    """
+    Reads traffic profile: JSON list of [weight, path] pairs, where path
+    may contain {user_id} placeholder, or access log in common log format,
+    whose GET requests are replayed with their recorded frequency.
+    """
+    with open(path, 'r') as profile_file:
+        content = profile_file.read()
+    try:
+        return [(weight, path) for weight, path in json.loads(content)]
+    except ValueError:
+        counts = Counter(LOG_REQUEST.findall(content))
+        return [(count, path) for path, count in sorted(counts.items())]
+
+
+def user_weights(user_ids, skew, seed=None):
+    """
+    Assigns Zipf-like weights to users, so a few of them get most of the
+    traffic, as real users looking mostly at themselves and their team.
+    """
+    user_ids = list(user_ids)
+    random.Random(seed).shuffle(user_ids)
+    return [
+        (1.0 / (rank + 1) ** skew, user_id)
+        for rank, user_id in enumerate(user_ids)
+    ]
+
+
+def weighted_choice(rng, choices):
+    """
+    Picks value from (weight, value) pairs.
+    """
+    point = rng.uniform(0, sum(weight for weight, _ in choices))
+    for weight, value in choices:
+        point -= weight
+        if point <= 0:
+            return value
+    return choices[-1][1]
+
+
+def request_paths(profile, users, count, seed=None):
+    """
+    Draws `count` request paths from profile, filling {user_id} from
+    weighted users.
+    """
+    rng = random.Random(seed)
+    paths = []
+    for _ in xrange(count):
+        path = weighted_choice(rng, profile)
+        if '{user_id}' in path:
+            path = path.format(user_id=weighted_choice(rng, users))
+        paths.append(path)
+    return paths
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    if not values:
+        return None
+    index = int(math.ceil(fraction * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+
+def run_level(base_url, paths, concurrency, timeout=30):
+    """
+    Requests all paths from `concurrency` threads.
+
+    Returns dictionary with number of requests and errors, duration,
+    throughput and p50/p95/p99 latencies (in seconds).
+    """
+    queue = iter(enumerate(paths))
+    lock = threading.Lock()
+    latencies = [None] * len(paths)
+    errors = Counter()
+
+    def worker():
+        """
+        Requests paths until there are none left.
+        """
+        while True:
+            with lock:
+                item = next(queue, None)
+            if item is None:
+                return
+            index, path = item
+            started = time.time()
+            try:
+                response = urllib2.urlopen(base_url + path, timeout=timeout)
+                response.read()
+            except urllib2.HTTPError as error:
+                errors[error.code] += 1
+            except Exception as error:  # pylint: disable-msg=W0703
+                errors[type(error).__name__] += 1
+            latencies[index] = time.time() - started
+
+    threads = [
+        threading.Thread(target=worker) for _ in range(concurrency)
+    ]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - started
+    latencies.sort()
+    return {
+        'concurrency': concurrency,
+        'requests': len(paths),
+        'errors': dict(errors),
+        'duration': duration,
+        'throughput': len(paths) / duration if duration else None,
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+    }
+
+
+class LocalInstance(object):
+    """
+    Application served by pre-forking server on a free local port.
+    """
+
+    def __init__(self, app, processes=4, max_requests=0):
+        from presence_analyzer.server import PreforkServer
+        self.server = PreforkServer(
+            app, '127.0.0.1', 0, processes, max_requests)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+
+    @property
+    def url(self):
+        """
+        Base URL of the instance.
+        """
+        return 'http://127.0.0.1:{}'.format(self.server.port)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.stop()
+        self.thread.join()
+
+
+def purge_cache(base_url, admin_token):
+    """
+    Purges caches of running instance through admin API.
+    """
+    request = urllib2.Request(
+        base_url + '/api/admin/cache', headers={'X-Admin-Token': admin_token})
+    request.get_method = lambda: 'DELETE'
+    urllib2.urlopen(request).read()
+
+
+def format_report(results):
+    """
+    Formats results as text table.
+    """
+    lines = ['{:>5} {:>11} {:>8} {:>7} {:>9} {:>9} {:>9}'.format(
+        'cache', 'concurrency', 'req/s', 'errors', 'p50 ms', 'p95 ms',
+        'p99 ms')]
+    for result in results:
+        lines.append(
+            '{:>5} {:>11} {:>8.1f} {:>7} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+                result['cache'], result['concurrency'],
+                result['throughput'] or 0, sum(result['errors'].values()),
+                result['p50'] * 1000, result['p95'] * 1000,
+                result['p99'] * 1000))
+    return '\n'.join(lines)
+
+
+def measure(base_url, paths, concurrency, cold=None):
+    """
+    Measures warm run, preceded by cold one when `cold` callable, which
+    empties caches of the instance, is given.
+    """
+    results = []
+    if cold is not None:
+        cold()
+        results.append(dict(run_level(base_url, paths, concurrency),
+                            cache='cold'))
+    results.append(dict(run_level(base_url, paths, concurrency),
+                        cache='warm'))
+    return results
+
+
+def main(argv=None):
+    """
+    Runs load test and prints its report.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        '--url', help='test running instance instead of starting one')
+    parser.add_argument(
+        '--admin-token', help='purge caches of running instance before '
+        'each level to measure cold runs (single process instances only)')
+    parser.add_argument(
+        '--config', help='configuration of started instance, '
+        'parts/etc/deploy.cfg by default')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--max-requests', type=int, default=0)
+    parser.add_argument(
+        '--concurrency', default='1,10,50',
+        help='comma separated concurrency levels')
+    parser.add_argument(
+        '--requests', type=int, default=500,
+        help='requests per run')
+    parser.add_argument(
+        '--profile', help='JSON profile or access log to replay')
+    parser.add_argument(
+        '--skew', type=float, default=1.1,
+        help='skew of Zipf-like user id distribution')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args(argv)
+
+    profile = read_profile(args.profile) if args.profile else DEFAULT_PROFILE
+    levels = [int(level) for level in args.concurrency.split(',')]
+    results = []
+    if args.url:
+        base_url = args.url.rstrip('/')
+        users = json.load(urllib2.urlopen(base_url + '/api/v1/users'))
+        weights = user_weights(
+            [user['user_id'] for user in users], args.skew, args.seed)
+        paths = request_paths(profile, weights, args.requests, args.seed)
+        cold = None
+        if args.admin_token:
+            sys.stderr.write(
+                'Warning: admin API purges caches of the worker process '
+                'handling the request only, cold runs are valid only '
+                'against single process instances.\n')
+            cold = partial(purge_cache, base_url, args.admin_token)
+        for level in levels:
+            results.extend(measure(base_url, paths, level, cold))
+    else:
+        from presence_analyzer.script import make_app, DEPLOY_CFG
+        from presence_analyzer.utils import get_data, purge_cache as purge
+        app = make_app(config=args.config or DEPLOY_CFG, schedule=False)
+        weights = user_weights(get_data().keys(), args.skew, args.seed)
+        # workers forked from this process must not inherit loaded data,
+        # parsed partitions of presence files included
+        purge()
+        paths = request_paths(profile, weights, args.requests, args.seed)
+        for level in levels:
+            with LocalInstance(
+                    app, args.processes, args.max_requests) as instance:
+                # caches of freshly started instance are empty already
+                results.extend(
+                    measure(instance.url, paths, level, cold=lambda: None))
+
+    if args.json:
+        print json.dumps(results, indent=2)
+    else:
+        print format_report(results)
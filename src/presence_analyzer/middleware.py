@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+WSGI middleware compressing responses.
+"""
+import os
+import gzip
+import calendar
+import logging
+import mimetypes
+from urlparse import parse_qs
+from cStringIO import StringIO
+from werkzeug.http import http_date, parse_date
+from werkzeug.security import safe_join
+from presence_analyzer.utils import atomic_file
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None  # pylint: disable-msg=C0103
+
+
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/json',
+    'application/javascript',
+    'application/x-javascript',
+    'application/vnd.presence-analyzer.columnar+json',
+    'image/svg+xml',
+)
+
+
+def gzip_compress(data, level=6):
+    """
+    Compresses data into gzip stream.
+    """
+    buff = StringIO()
+    with gzip.GzipFile(fileobj=buff, mode='wb', compresslevel=level,
+                       mtime=0) as gzip_file:
+        gzip_file.write(data)
+    return buff.getvalue()
+
+
+def brotli_compress(data, level=6):
+    """
+    Compresses data into brotli stream.
+    """
+    return brotli.compress(data, quality=level)
+
+
+def encodings():
+    """
+    Lists available (encoding, file suffix, compress function) in order
+    of preference.
+    """
+    result = [('gzip', '.gz', gzip_compress)]
+    if brotli is not None:
+        result.insert(0, ('br', '.br', brotli_compress))
+    return result
+
+
+def is_compressible(mimetype):
+    """
+    Checks if content of given type is worth compressing.
+    """
+    return bool(mimetype) and mimetype.startswith(COMPRESSIBLE_TYPES)
+
+
+def accepted_encodings(environ):
+    """
+    Parses Accept-Encoding request header into set of accepted encodings.
+    """
+    accepted = set()
+    for item in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = item.strip().split(';')
+        encoding = params[0].strip().lower()
+        quality = [param for param in params[1:]
+                   if param.strip().replace(' ', '') in ('q=0', 'q=0.0')]
+        if encoding and not quality:
+            accepted.add(encoding)
+    return accepted
+
+
+def precompress_static(directory, level=9):
+    """
+    Writes compressed copy next to each compressible static file.
+
+    Up to date copies are kept, so it is cheap to run on every startup.
+    """
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            if not is_compressible(mimetypes.guess_type(path)[0]):
+                continue
+            with open(path, 'rb') as static_file:
+                content = None
+                for _, suffix, compress in encodings():
+                    target = path + suffix
+                    if os.path.exists(target) and \
+                            os.path.getmtime(target) >= os.path.getmtime(path):
+                        continue
+                    if content is None:
+                        content = static_file.read()
+                    try:
+                        with atomic_file(target) as compressed:
+                            compressed.write(compress(content, level))
+                    except (IOError, OSError):
+                        log.warning('Cannot precompress %s', path,
+                                    exc_info=True)
+
+
+def add_vary(headers, value='Accept-Encoding'):
+    """
+    Adds value to Vary header of given header list.
+    """
+    for i, (name, current) in enumerate(headers):
+        if name.lower() == 'vary':
+            if value.lower() not in current.lower():
+                headers[i] = (name, '{}, {}'.format(current, value))
+            return
+    headers.append(('Vary', value))
+
+
+class CompressionMiddleware(object):
+    """
+    Compresses dynamic responses and serves precompressed static files.
+
+    Static files are cached by clients for `max_age` seconds only when
+    requested with version ('v' query argument, see `static_version`),
+    unversioned URLs have to be revalidated.
+    """
+
+    def __init__(self, app, static_url_path, static_folder, min_size=1024,
+                 level=6, max_age=31536000):
+        self.app = app
+        self.static_url_path = static_url_path.rstrip('/') + '/'
+        self.static_folder = static_folder
+        self.min_size = min_size
+        self.level = level
+        self.max_age = max_age
+
+    def __call__(self, environ, start_response):
+        accepted = accepted_encodings(environ)
+        if environ.get('REQUEST_METHOD') == 'GET' and accepted:
+            path = environ.get('PATH_INFO', '')
+            if path.startswith(self.static_url_path):
+                response = self.serve_static(
+                    path[len(self.static_url_path):], accepted,
+                    environ, start_response)
+                if response is not None:
+                    return response
+            return self.compress(environ, start_response, accepted)
+        return self.compress(environ, start_response, set())
+
+    def serve_static(self, filename, accepted, environ, start_response):
+        """
+        Serves precompressed copy of static file, if there is one.
+        """
+        path = safe_join(self.static_folder, filename)
+        if path is None or not os.path.isfile(path):
+            return None
+        for encoding, suffix, _ in encodings():
+            target = path + suffix
+            if encoding not in accepted or not os.path.isfile(target) or \
+                    os.path.getmtime(target) < os.path.getmtime(path):
+                continue
+            mimetype = mimetypes.guess_type(path)[0]
+            versioned = 'v' in parse_qs(environ.get('QUERY_STRING', ''))
+            mtime = os.path.getmtime(path)
+            headers = [
+                ('Cache-Control', 'public, max-age={}'.format(
+                    self.max_age if versioned else 0)),
+                ('Last-Modified', http_date(mtime)),
+                ('Vary', 'Accept-Encoding'),
+            ]
+            since = parse_date(environ.get('HTTP_IF_MODIFIED_SINCE'))
+            if since is not None and \
+                    int(mtime) <= calendar.timegm(since.utctimetuple()):
+                start_response('304 Not Modified', headers)
+                return []
+            start_response('200 OK', [
+                ('Content-Type', mimetype or 'application/octet-stream'),
+                ('Content-Encoding', encoding),
+                ('Content-Length', str(os.path.getsize(target))),
+            ] + headers)
+            static_file = open(target, 'rb')
+            file_wrapper = environ.get('wsgi.file_wrapper')
+            if file_wrapper is not None:
+                return file_wrapper(static_file)
+            return FileIterator(static_file)
+        return None
+
+    def compress(self, environ, start_response, accepted):
+        """
+        Compresses response of wrapped application when it is worth it.
+        """
+        captured = []
+
+        def capture(status, headers, exc_info=None):
+            """
+            Defers start_response until compression is decided.
+            """
+            captured[:] = [status, headers, exc_info]
+            return lambda data: None
+
+        app_iter = self.app(environ, capture)
+        status, headers, exc_info = captured
+        header_names = dict(
+            (name.lower(), value) for name, value in headers)
+        mimetype = header_names.get('content-type', '').split(';')[0]
+        if not is_compressible(mimetype) or \
+                'content-encoding' in header_names:
+            start_response(status, headers, exc_info)
+            return app_iter
+
+        headers = list(headers)
+        add_vary(headers)
+        encoding = None
+        for name, _, compress in encodings():
+            if name in accepted:
+                encoding = name
+                break
+        length = header_names.get('content-length')
+        if encoding is None or (length is not None and
+                                int(length) < self.min_size):
+            start_response(status, headers, exc_info)
+            return app_iter
+
+        try:
+            body = ''.join(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        if len(body) >= self.min_size:
+            body = compress(body, self.level)
+            headers = [(name, value) for name, value in headers
+                       if name.lower() != 'content-length']
+            headers.append(('Content-Encoding', encoding))
+            headers.append(('Content-Length', str(len(body))))
+        start_response(status, headers, exc_info)
+        return [body]
+
+
+class FileIterator(object):
+    """
+    Iterates over file in chunks, closing it when done.
+    """
+
+    def __init__(self, file_object, chunk_size=64 * 1024):
+        self.file_object = file_object
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        return iter(lambda: self.file_object.read(self.chunk_size), '')
+
+    def close(self):
+        """
+        Closes wrapped file.
+        """
+        self.file_object.close()
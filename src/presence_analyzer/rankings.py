@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Ranking of users by their presence aggregates.
+"""
+import heapq
+from bisect import bisect_left, bisect_right
+
+
+ALL_DAYS = 7
+COLUMNS = ('presence', 'start', 'end')
+
+
+def mean_of(column):
+    """
+    Creates metric averaging given column over days.
+    """
+    def metric(days, sums):
+        """
+        Mean of column per day.
+        """
+        return float(sums[column]) / days
+    return metric
+
+
+METRICS = {
+    'presence': lambda days, sums: sums['presence'],
+    'mean_presence': mean_of('presence'),
+    'arrival': mean_of('start'),
+    'departure': mean_of('end'),
+}
+
+
+class UserAggregates(object):
+    """
+    Prefix sums of daily presence, start and end of single user.
+
+    Sums are kept for all days and for every weekday separately, so totals
+    of any date range, optionally limited to one weekday, take O(log n).
+    """
+
+    def __init__(self):
+        self.ordinals = [[] for _ in range(ALL_DAYS + 1)]
+        self.sums = [
+            dict((column, [0]) for column in COLUMNS)
+            for _ in range(ALL_DAYS + 1)
+        ]
+
+    def add_day(self, day, presence, start, end):
+        """
+        Adds presence day. Days have to be added in chronological order.
+        """
+        values = {'presence': presence, 'start': start, 'end': end}
+        for group in (day.weekday(), ALL_DAYS):
+            self.ordinals[group].append(day.toordinal())
+            for column in COLUMNS:
+                sums = self.sums[group][column]
+                sums.append(sums[-1] + values[column])
+
+    def summary(self, since=None, until=None, weekday=None):
+        """
+        Returns number of days and dictionary of column sums in given
+        date range (inclusive) and weekday.
+        """
+        group = ALL_DAYS if weekday is None else weekday
+        ordinals = self.ordinals[group]
+        low = bisect_left(ordinals, since.toordinal()) if since else 0
+        high = (bisect_right(ordinals, until.toordinal()) if until
+                else len(ordinals))
+        sums = dict(
+            (column, values[high] - values[low])
+            for column, values in self.sums[group].items()
+        )
+        return max(high - low, 0), sums
+
+
+def score(aggregates, metric, since=None, until=None, weekday=None):
+    """
+    Returns (value, user_id, days) tuples of given metric of every user
+    having days in given date range (inclusive) and weekday.
+
+    `aggregates` are (user_id, UserAggregates) pairs.
+    """
+    function = METRICS[metric]
+    candidates = []
+    for user_id, user_aggregates in aggregates:
+        days, sums = user_aggregates.summary(since, until, weekday)
+        if days:
+            candidates.append((function(days, sums), user_id, days))
+    return candidates
+
+
+def rank(candidates, limit, largest=True):
+    """
+    Selects `limit` candidates with largest (or smallest) value.
+
+    `candidates` are (value, user_id, days) tuples, see `score`. Uses
+    partial heap selection instead of sorting all users. Ties are
+    resolved by lower user id.
+    """
+    if largest:
+        return heapq.nlargest(
+            limit, candidates, key=lambda item: (item[0], -item[1]))
+    return heapq.nsmallest(
+        limit, candidates, key=lambda item: (item[0], item[1]))
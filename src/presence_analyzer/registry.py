@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Dense indices of sparse user ids.
+"""
+import threading
+from array import array
+
+
+class IdRegistry(object):
+    """
+    Maps external user ids (as found in users.xml and presence data) to
+    dense indices 0..n-1.
+
+    Indices are assigned once and never reused, so per-user arrays indexed
+    by them stay valid when data is reloaded and new users appear.
+    """
+
+    def __init__(self):
+        self.ids = array('i')
+        self.indices = {}
+        self.lock = threading.Lock()
+
+    def register(self, user_ids):
+        """
+        Assigns indices to unknown user ids, in ascending order.
+        """
+        unknown = set(user_ids).difference(self.indices)
+        if not unknown:
+            return
+        with self.lock:
+            for user_id in sorted(unknown):
+                if user_id not in self.indices:
+                    self.indices[user_id] = len(self.ids)
+                    self.ids.append(user_id)
+
+    def index(self, user_id):
+        """
+        Dense index of given user id, None for unknown ones.
+        """
+        return self.indices.get(user_id)
+
+    def column(self, values, default=None):
+        """
+        Lays out {user_id: value} mapping as list indexed by dense index.
+        """
+        result = [default] * len(self.ids)
+        for user_id, value in values.iteritems():
+            result[self.indices[user_id]] = value
+        return result
+
+    def __contains__(self, user_id):
+        return user_id in self.indices
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class UserDirectory(object):
+    """
+    Users from users.xml joined with presence data by dense index.
+
+    `users` holds user metadata (None for users missing in users.xml) and
+    `present` flags users having presence data.
+    """
+
+    def __init__(self, registry, users, data):
+        registry.register(user['id'] for user in users)
+        registry.register(data)
+        self.registry = registry
+        self.users = registry.column(
+            dict((user['id'], user) for user in users))
+        self.present = array('b', [0]) * len(self.users)
+        for user_id in data:
+            self.present[registry.index(user_id)] = 1
+        self.order = [registry.index(user['id']) for user in users]
+
+    def user(self, user_id):
+        """
+        Metadata of given user, None for users missing in users.xml.
+        """
+        index = self.registry.index(user_id)
+        if index is None or index >= len(self.users):
+            return None
+        return self.users[index]
+
+    def listing(self, present=False):
+        """
+        Metadata of all users in users.xml order, optionally only of the
+        ones having presence data.
+        """
+        return [
+            self.users[index] for index in self.order
+            if not present or self.present[index]
+        ]
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Calendar based rollups of presence: per-week, per-month and per-year.
+"""
+
+TEAM = 'team'
+
+
+def week_key(day):
+    """
+    ISO week given date belongs to, like '2013-W37'.
+    """
+    year, week, _ = day.isocalendar()
+    return '{:04d}-W{:02d}'.format(year, week)
+
+
+def month_key(day):
+    """
+    Month given date belongs to, like '2013-09'.
+    """
+    return '{:04d}-{:02d}'.format(day.year, day.month)
+
+
+def year_key(day):
+    """
+    Year given date belongs to, like '2013'.
+    """
+    return '{:04d}'.format(day.year)
+
+
+PERIODS = {
+    'week': week_key,
+    'month': month_key,
+    'year': year_key,
+}
+
+
+class Rollups(object):
+    """
+    Presence totals and days count per calendar period for every user
+    and for the whole team.
+
+    Buckets are updated in O(1) per presence day, so they are built in
+    a single pass over presence data, once per data generation.
+    """
+
+    def __init__(self):
+        self.buckets = dict((period, {}) for period in PERIODS)
+        self.sorted = {}
+
+    def add(self, user_id, day, seconds):
+        """
+        Adds presence seconds of given user and date.
+        """
+        for period, key_function in PERIODS.items():
+            key = key_function(day)
+            for owner in (user_id, TEAM):
+                bucket = self.buckets[period].setdefault(
+                    owner, {}).setdefault(key, [0, 0])
+                bucket[0] += seconds
+                bucket[1] += 1
+
+    def series(self, period, owner):
+        """
+        Returns (periods, totals, days, means) parallel lists of given
+        user or team, ordered by period. None for unknown owners.
+        """
+        buckets = self.buckets[period].get(owner)
+        if buckets is None:
+            return None
+        result = self.sorted.get((period, owner))
+        if result is None:
+            keys = sorted(buckets)
+            totals = [buckets[key][0] for key in keys]
+            days = [buckets[key][1] for key in keys]
+            means = [
+                float(total) / count if count else 0
+                for total, count in zip(totals, days)
+            ]
+            result = self.sorted[(period, owner)] = keys, totals, days, means
+        return result
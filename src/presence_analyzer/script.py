@@ -26,10 +26,32 @@ del _buildout_path
 
 
 # bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False, schedule=True):
     from presence_analyzer import app
+    from presence_analyzer.utils import schedule_users_xml_import
+    from presence_analyzer.middleware import (
+        CompressionMiddleware,
+        precompress_static,
+    )
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    if app.config.get('COMPRESS_RESPONSES', True) and \
+            not isinstance(app.wsgi_app, CompressionMiddleware):
+        max_age = app.config.get('STATIC_MAX_AGE', 31536000)
+        # unversioned static URLs are revalidated, see static_version
+        app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
+        precompress_static(app.static_folder)
+        app.wsgi_app = CompressionMiddleware(
+            app.wsgi_app,
+            app.static_url_path,
+            app.static_folder,
+            min_size=app.config.get('COMPRESS_MIN_SIZE', 1024),
+            max_age=max_age,
+        )
+    refresh = app.config.get('USERS_DATA_XML_REFRESH')
+    if schedule and refresh and 'users_xml_importer' not in app.extensions:
+        app.extensions['users_xml_importer'] = schedule_users_xml_import(
+            refresh)
     return app
 
 
@@ -50,17 +72,21 @@ def make_shell():
     return locals()
 
 
-def _serve(action, debug=False, dry_run=False):
-    """Build paster command from 'action' and 'debug' flag."""
+def _serve(action, debug=False, dry_run=False, prefork=False):
+    """Build paster command from 'action', 'debug' and 'prefork' flags."""
     if debug:
         config = DEBUG_INI
     else:
         config = DEPLOY_INI
     argv = ['bin/paster', 'serve', config]
+    if prefork:
+        argv += ['--server-name=prefork']
     if action in ('start', 'restart'):
         argv += [action, '--daemon']
     elif action in ('', 'fg', 'foreground'):
-        argv += ['--reload']
+        # reloader restarts only the master, workers would keep the port
+        if not prefork:
+            argv += ['--reload']
     else:
         argv += [action]
     # Print the 'paster' command
@@ -78,12 +104,19 @@ def _serve(action, debug=False, dry_run=False):
     paste.script.command.run()
 
 
+# bin/import_xml_url
+def import_users_xml():
+    from presence_analyzer.utils import import_user_xml_form_url
+    make_app(schedule=False)
+    import_user_xml_form_url()
+
+
 # bin/flask-ctl ...
 def run():
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
 
-    # bin/flask-ctl serve [fg|start|stop|restart|status]
-    def action_serve(action=('a', 'start'), dry_run=False):
+    # bin/flask-ctl serve [fg|start|stop|restart|status] [--prefork]
+    def action_serve(action=('a', 'start'), dry_run=False, prefork=False):
         """Serve the application.
 
         This command serves a web application that uses a paste.deploy
@@ -92,8 +125,10 @@ def run():
         Options:
          - 'action' is one of [fg|start|stop|restart|status]
          - '--dry-run' print the paster command and exit
+         - '--prefork' serve from pre-forked worker processes instead
+           of the thread pool, 'fg' then runs without code reloader
         """
-        _serve(action, debug=False, dry_run=dry_run)
+        _serve(action, debug=False, dry_run=dry_run, prefork=prefork)
 
     # bin/flask-ctl debug [fg|start|stop|restart|status]
     def action_debug(action=('a', 'start'), dry_run=False):
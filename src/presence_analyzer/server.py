@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-forking WSGI server.
+"""
+import os
+import time
+import errno
+import signal
+import logging
+from wsgiref.simple_server import (
+    WSGIServer,
+    WSGIRequestHandler,
+    make_server,
+)
+
+
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+MASTER_CHECK_INTERVAL = 1
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """
+    Request handler logging through logging module instead of stderr.
+    """
+
+    def log_message(self, format, *args):  # pylint: disable-msg=W0622
+        log.debug('%s - %s', self.address_string(), format % args)
+
+
+class CountingWSGIServer(WSGIServer):
+    """
+    WSGI server counting requests it handled.
+    """
+    handled = 0
+
+    def process_request(self, request, client_address):
+        self.handled += 1
+        WSGIServer.process_request(self, request, client_address)
+
+
+class PreforkServer(object):
+    """
+    Serves WSGI application from several forked worker processes.
+
+    All workers accept connections on one listening socket. Worker exits
+    after serving `max_requests` requests (0 means never) and master
+    process replaces it with a fresh one.
+
+    Every callable of `tasks` is started in its own process, e.g. to run
+    background threads which must not be running in the master while it
+    forks. Tasks are restarted when their process exits. Workers and
+    tasks exit once the master is gone.
+    """
+
+    def __init__(self, app, host, port, processes=4, max_requests=0,
+                 tasks=()):
+        self.server = make_server(
+            host, int(port), app, CountingWSGIServer, QuietRequestHandler)
+        self.server.timeout = MASTER_CHECK_INTERVAL
+        self.processes = int(processes)
+        self.max_requests = int(max_requests)
+        self.tasks = list(tasks)
+        self.workers = {}
+        self.running = False
+
+    @property
+    def port(self):
+        """
+        Port server is listening on.
+        """
+        return self.server.server_port
+
+    def spawn(self, task=None):
+        """
+        Forks new worker process, or process running given task.
+        """
+        master = os.getpid()
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = task
+            return pid
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            if task is not None:
+                task()
+            while os.getppid() == master:
+                if task is not None:
+                    time.sleep(MASTER_CHECK_INTERVAL)
+                elif self.max_requests and \
+                        self.server.handled >= self.max_requests:
+                    break
+                else:
+                    self.server.handle_request()
+        except Exception:  # pylint: disable-msg=W0703
+            log.exception('Worker %s failed.', os.getpid())
+        finally:
+            os._exit(0)  # pylint: disable-msg=W0212
+
+    def serve_forever(self):
+        """
+        Starts workers and tasks and keeps them running until stopped.
+        """
+        self.running = True
+        for task in self.tasks:
+            self.spawn(task)
+        for _ in range(self.processes):
+            self.spawn()
+        while self.workers:
+            try:
+                pid, _ = os.wait()
+            except OSError as error:
+                if error.errno == errno.EINTR:
+                    continue
+                raise
+            task = self.workers.pop(pid, None)
+            if self.running:
+                log.debug('Worker %s exited, respawning.', pid)
+                self.spawn(task)
+        self.server.server_close()
+
+    def stop(self, *args):
+        """
+        Stops all workers.
+        """
+        self.running = False
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                self.workers.pop(pid, None)
+
+
+def preload():
+    """
+    Loads cached data, so forked workers share it copy-on-write.
+    """
+    from presence_analyzer.utils import (
+        get_data,
+        get_rollups,
+        get_user_aggregates,
+        get_norms,
+        get_directory,
+        parse_user_data_xml,
+    )
+    for loader in (get_data, get_rollups, get_user_aggregates, get_norms,
+                   parse_user_data_xml, get_directory):
+        try:
+            loader()
+        except Exception:  # pylint: disable-msg=W0703
+            log.exception('Cannot preload %s.', loader.__name__)
+
+
+# [server:prefork] use = egg:presence_analyzer#prefork
+def prefork_server_runner(wsgi_app, global_conf, host='0.0.0.0', port=8100,
+                          processes=4, max_requests=0, preload_data=True):
+    """
+    Paste server runner for PreforkServer.
+
+    Users XML importer scheduled by the application is moved from the
+    master into process of its own, as forking while its thread holds a
+    lock could leave the lock held forever in the worker.
+    """
+    from functools import partial
+    from paste.deploy.converters import asbool
+    from presence_analyzer.main import app
+    from presence_analyzer.utils import schedule_users_xml_import
+    tasks = []
+    importer = app.extensions.pop('users_xml_importer', None)
+    if importer is not None:
+        importer.stop.set()
+        importer.join()
+        tasks.append(partial(
+            schedule_users_xml_import, app.config['USERS_DATA_XML_REFRESH']))
+    if asbool(preload_data):
+        preload()
+    server = PreforkServer(
+        wsgi_app, host, port, processes, max_requests, tasks)
+    signal.signal(signal.SIGTERM, server.stop)
+    signal.signal(signal.SIGINT, server.stop)
+    log.info('Serving on http://%s:%s with %s processes.',
+             host, server.port, server.processes)
+    server.serve_forever()
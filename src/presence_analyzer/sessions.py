@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Compact store of user work sessions.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import izip
+from datetime import date, time
+
+
+def seconds_to_time(seconds):
+    """
+    Converts amount of seconds since midnight to datetime.time.
+    """
+    return time(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+class UserSessions(object):
+    """
+    Work sessions of single user.
+
+    Sessions are kept in parallel arrays of date ordinals, starts and ends
+    (seconds since midnight), sorted by date and start, with overlapping
+    sessions of the same day merged. There can be many sessions per day.
+
+    Mapping interface matches per-user dictionaries of `get_data()`:
+    date -> {'start': start of first session, 'end': end of last session}.
+    """
+
+    def __init__(self, days=(), starts=(), ends=()):
+        self.days = array('i', days)
+        self.starts = array('i', starts)
+        self.ends = array('i', ends)
+        self._index = None
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Builds sessions from (date ordinal, start, end) rows in any order.
+        """
+        sessions = cls()
+        days, starts, ends = sessions.days, sessions.starts, sessions.ends
+        last_day = last_end = None
+        for day, start, end in sorted(rows):
+            if day == last_day and start <= last_end:
+                if end > last_end:
+                    ends[-1] = last_end = end
+                continue
+            days.append(day)
+            starts.append(start)
+            ends.append(end)
+            last_day, last_end = day, end
+        return sessions
+
+    def index(self):
+        """
+        Lists distinct date ordinals with offsets their sessions start at.
+        """
+        if self._index is None:
+            ordinals, offsets = [], []
+            previous = None
+            for i, day in enumerate(self.days):
+                if day != previous:
+                    ordinals.append(day)
+                    offsets.append(i)
+                    previous = day
+            offsets.append(len(self.days))
+            self._index = ordinals, offsets
+        return self._index
+
+    def daily(self):
+        """
+        Yields (date, low, high) where sessions of date are low:high slice
+        of the arrays.
+        """
+        ordinals, offsets = self.index()
+        for i, day in enumerate(ordinals):
+            yield date.fromordinal(day), offsets[i], offsets[i + 1]
+
+    def sessions(self):
+        """
+        Yields (date ordinal, start, end) of every session.
+        """
+        return izip(self.days, self.starts, self.ends)
+
+    def __len__(self):
+        return len(self.index()[0])
+
+    def __iter__(self):
+        for day in self.index()[0]:
+            yield date.fromordinal(day)
+
+    def __contains__(self, day):
+        ordinal = day.toordinal()
+        low = bisect_left(self.days, ordinal)
+        return low < len(self.days) and self.days[low] == ordinal
+
+    def __getitem__(self, day):
+        ordinal = day.toordinal()
+        low = bisect_left(self.days, ordinal)
+        high = bisect_right(self.days, ordinal)
+        if low == high:
+            raise KeyError(day)
+        return {
+            'start': seconds_to_time(self.starts[low]),
+            'end': seconds_to_time(self.ends[high - 1]),
+        }
+
+    def __eq__(self, other):
+        if not isinstance(other, UserSessions):
+            return NotImplemented
+        return (self.days == other.days and self.starts == other.starts
+                and self.ends == other.ends)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __repr__(self):
+        return '<UserSessions: {} sessions in {} days>'.format(
+            len(self.days), len(self))
+
+    def keys(self):
+        """
+        List of dates with presence.
+        """
+        return list(self)
+
+    def items(self):
+        """
+        List of (date, {'start', 'end'}) pairs.
+        """
+        return [(day, self[day]) for day in self]
+
+    def get(self, day, default=None):
+        """
+        Presence of given date or default.
+        """
+        try:
+            return self[day]
+        except KeyError:
+            return default
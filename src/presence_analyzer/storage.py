@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+Time-partitioned on-disk storage of presence data.
+
+Presence rows are kept in one binary columnar file per month, described
+by small JSON manifest. Month files are loaded lazily on first touch and
+evicted in least recently used order when memory budget is exceeded.
+"""
+import os
+import json
+import time
+import uuid
+import array
+import fcntl
+import struct
+import logging
+import threading
+from contextlib import contextmanager
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import date
+from presence_analyzer.sessions import UserSessions
+
+
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+MANIFEST = 'manifest.json'
+LOCK = '.build.lock'
+GRACE_PERIOD = 3600
+MAGIC = 'PAM1'
+HEADER = struct.Struct('<4sI')
+COLUMNS = ('user_id', 'day', 'start', 'end')
+ROW_SIZE = len(COLUMNS) * array.array('i').itemsize
+
+
+def month_key(day):
+    """
+    Name of partition given date belongs to.
+    """
+    return '{:04d}-{:02d}'.format(day.year, day.month)
+
+
+class MonthPartition(object):
+    """
+    Presence rows of single month, sorted by user, date and start.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    @property
+    def size(self):
+        """
+        Memory taken by partition columns, in bytes.
+        """
+        return len(self.columns['user_id']) * ROW_SIZE
+
+    @classmethod
+    def read(cls, path):
+        """
+        Reads partition from binary file.
+        """
+        with open(path, 'rb') as month_file:
+            magic, rows = HEADER.unpack(month_file.read(HEADER.size))
+            if magic != MAGIC:
+                raise IOError('{} is not presence partition'.format(path))
+            columns = {}
+            for name in COLUMNS:
+                columns[name] = array.array('i')
+                columns[name].fromfile(month_file, rows)
+        return cls(columns)
+
+    def write(self, path):
+        """
+        Writes partition into binary file.
+        """
+        with open(path, 'wb') as month_file:
+            month_file.write(
+                HEADER.pack(MAGIC, len(self.columns['user_id'])))
+            for name in COLUMNS:
+                self.columns[name].tofile(month_file)
+
+    def rows(self, offset, count):
+        """
+        Yields (day, start, end) of given rows range.
+        """
+        columns = self.columns
+        end = offset + count
+        for i in xrange(offset, end):
+            yield columns['day'][i], columns['start'][i], columns['end'][i]
+
+
+class PresenceStore(object):
+    """
+    Read-only mapping of user_id to sessions backed by month files.
+
+    Behaves like the dictionary built by `get_data()`, loading only
+    partitions which hold data of requested users.
+    """
+
+    def __init__(self, directory, manifest, budget):
+        self.directory = directory
+        self.manifest = manifest
+        self.budget = budget
+        self.loaded = OrderedDict()
+        self.lock = threading.Lock()
+        self.users = {}
+        for key in sorted(manifest['months']):
+            for user_id in manifest['months'][key]['users']:
+                self.users.setdefault(int(user_id), []).append(key)
+
+    @property
+    def sources(self):
+        """
+        Signature of files the store was built from.
+        """
+        return [tuple(source) for source in self.manifest['sources']]
+
+    @property
+    def loaded_bytes(self):
+        """
+        Memory taken by currently loaded partitions.
+        """
+        return sum(partition.size for partition in self.loaded.values())
+
+    def month(self, key):
+        """
+        Returns partition of given month, loading it if needed.
+        """
+        with self.lock:
+            partition = self.loaded.pop(key, None)
+            if partition is None:
+                path = os.path.join(
+                    self.directory, self.manifest['months'][key]['file'])
+                partition = MonthPartition.read(path)
+                log.debug('Partition %s loaded.', key)
+            self.loaded[key] = partition
+            while len(self.loaded) > 1 and self.loaded_bytes > self.budget:
+                evicted, _ = self.loaded.popitem(last=False)
+                log.debug('Partition %s evicted.', evicted)
+            return partition
+
+    def user_data(self, user_id, since=None, until=None):
+        """
+        Builds sessions of given user, optionally limited to dates between
+        `since` and `until` (inclusive).
+
+        Only partitions overlapping requested dates are touched.
+        """
+        keys = self.users.get(user_id, [])
+        first = bisect_left(keys, month_key(since)) if since else 0
+        last = bisect_right(keys, month_key(until)) if until else len(keys)
+        since = since.toordinal() if since else None
+        until = until.toordinal() if until else None
+        result = UserSessions()
+        for key in keys[first:last]:
+            offset, count = self.manifest['months'][key]['users'][
+                str(user_id)]
+            for day, start, end in self.month(key).rows(offset, count):
+                if since and day < since or until and day > until:
+                    continue
+                result.days.append(day)
+                result.starts.append(start)
+                result.ends.append(end)
+        return result
+
+    def scan(self, since=None, until=None):
+        """
+        Yields (user_id, sessions) of every user month by month, so a
+        full pass reads each partition once, whatever the memory budget.
+
+        Users present in many months come once per month, in
+        chronological order. Only months overlapping dates between
+        `since` and `until` (inclusive) are read.
+        """
+        keys = sorted(self.manifest['months'])
+        first = bisect_left(keys, month_key(since)) if since else 0
+        last = bisect_right(keys, month_key(until)) if until else len(keys)
+        for key in keys[first:last]:
+            users = self.manifest['months'][key]['users']
+            columns = self.month(key).columns
+            for user_id in sorted(users, key=int):
+                offset, count = users[user_id]
+                end = offset + count
+                yield int(user_id), UserSessions(
+                    columns['day'][offset:end],
+                    columns['start'][offset:end],
+                    columns['end'][offset:end])
+
+    def __contains__(self, user_id):
+        return user_id in self.users
+
+    def __iter__(self):
+        return iter(sorted(self.users))
+
+    def __len__(self):
+        return len(self.users)
+
+    def __getitem__(self, user_id):
+        if user_id not in self.users:
+            raise KeyError(user_id)
+        return self.user_data(user_id)
+
+    def keys(self):
+        """
+        Sorted list of user ids.
+        """
+        return sorted(self.users)
+
+    def get(self, user_id, default=None):
+        """
+        Sessions of given user or default.
+        """
+        if user_id not in self.users:
+            return default
+        return self.user_data(user_id)
+
+
+def read_manifest(directory):
+    """
+    Reads storage manifest, returns None when there is no valid one.
+    """
+    try:
+        with open(os.path.join(directory, MANIFEST), 'r') as manifest_file:
+            return json.load(manifest_file)
+    except (IOError, ValueError):
+        return None
+
+
+def write_atomic(path, content):
+    """
+    Replaces file content atomically.
+    """
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    with open(tmp_path, 'wb') as tmp_file:
+        tmp_file.write(content)
+    os.rename(tmp_path, path)
+
+
+def open_store(directory, sources, budget):
+    """
+    Opens store built from files with given signature, None if there is
+    no such store.
+    """
+    manifest = read_manifest(directory)
+    if manifest is None:
+        return None
+    store = PresenceStore(directory, manifest, budget)
+    if store.sources != [tuple(source) for source in sources]:
+        return None
+    return store
+
+
+@contextmanager
+def build_lock(directory):
+    """
+    Holds exclusive lock of store directory, shared by all processes.
+
+    Store should be built only while holding it, as processes building
+    at the same time would remove each other's partition files.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(os.path.join(directory, LOCK), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def build_store(directory, sources, data, budget, extra=None):
+    """
+    Writes sessions into month partitions and opens store over them.
+
+    Has to be called with `build_lock` held. New partition files get
+    unique names and manifest is replaced atomically, so stores opened
+    from previous manifests keep working. Files referenced by neither
+    manifest are removed once they are older than GRACE_PERIOD.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    rows = {}
+    for user_id in data:
+        for day, start, end in data[user_id].sessions():
+            rows.setdefault(month_key(date.fromordinal(day)), []).append(
+                (user_id, day, start, end))
+    build = uuid.uuid4().hex[:8]
+    months = {}
+    for key, month_rows in rows.items():
+        month_rows.sort()
+        columns = dict((name, array.array('i')) for name in COLUMNS)
+        users = {}
+        for i, row in enumerate(month_rows):
+            users.setdefault(str(row[0]), [i, 0])[1] += 1
+            for name, value in zip(COLUMNS, row):
+                columns[name].append(value)
+        name = '{}.{}.bin'.format(key, build)
+        MonthPartition(columns).write(os.path.join(directory, name))
+        months[key] = {'file': name, 'rows': len(month_rows), 'users': users}
+    previous = read_manifest(directory) or {'months': {}}
+    manifest = {
+        'version': 1,
+        'sources': [list(source) for source in sources],
+        'months': months,
+        'extra': extra or {},
+    }
+    write_atomic(os.path.join(directory, MANIFEST), json.dumps(manifest))
+    keep = set(month['file'] for month in months.values())
+    keep.update(month['file'] for month in previous['months'].values())
+    expired = time.time() - GRACE_PERIOD
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith('.bin') and name not in keep and \
+                os.path.getmtime(path) < expired:
+            os.unlink(path)
+    return PresenceStore(directory, manifest, budget)
@@ -2,12 +2,38 @@
 """
 Presence analyzer unit tests.
 """
+import os
 import os.path
+import bz2
+import csv
+import gzip
 import json
+import shutil
+import signal
+import tempfile
 import datetime
+import time
 import unittest
+import threading
+import urllib2
+import BaseHTTPServer
 
-from presence_analyzer import main, views, utils
+from cStringIO import StringIO
+from collections import Counter
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from presence_analyzer import (
+    main,
+    anomalies,
+    loadtest,
+    registry,
+    views,
+    utils,
+    middleware,
+    server,
+    storage,
+)
 
 
 TEST_DATA_CSV = os.path.join(
@@ -25,6 +51,17 @@ TEST_USERS_XML = os.path.join(
 
 
 # pylint: disable=E1103
+def gzip_compress(content):
+    """
+    Compresses content into single gzip member.
+    """
+    buf = StringIO()
+    gzip_file = gzip.GzipFile(fileobj=buf, mode='wb')
+    gzip_file.write(content)
+    gzip_file.close()
+    return buf.getvalue()
+
+
 class PresenceAnalyzerViewsTestCase(unittest.TestCase):
     """
     Views tests.
@@ -34,8 +71,11 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         """
         Before each test, set up a environment.
         """
+        utils.CACHE = {}
+        utils.TIMESTAMPS = {}
+        utils.HITS.clear()
         main.app.config.update({
-            'DATA_CSV': TEST_DATA_CSV, 'USERS_XML': TEST_USERS_XML})
+            'DATA_CSV': TEST_DATA_CSV, 'USERS_DATA_XML': TEST_USERS_XML})
         self.client = main.app.test_client()
 
     def tearDown(self):
@@ -58,6 +98,39 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         """
         resp = self.client.get('/chart/presence_weekday')
         self.assertEqual(resp.status_code, 200)
+        self.assertIn('users: null', resp.data)
+        mtime = int(os.path.getmtime(
+            os.path.join(main.app.static_folder, 'css', 'style.css')))
+        self.assertIn('/static/css/style.css?v={}"'.format(mtime), resp.data)
+        resp = self.client.get('/static/css/style.css?v={}'.format(mtime))
+        self.assertEqual(resp.cache_control.max_age, 31536000)
+        resp.close()
+        resp = self.client.get(
+            '/chart/presence_weekday', base_url='http://localhost/app/')
+        self.assertIn('"/app/api/v2/user/0/dashboard"', resp.data)
+
+    def test_chart_embedded_data(self):
+        """
+        Test chart page with embedded users list and user dashboard.
+        """
+        main.app.config.update({'EMBED_DATA': True})
+        self.addCleanup(main.app.config.pop, 'EMBED_DATA')
+        resp = self.client.get('/chart/presence_start_end?user_id=11')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('users: [{', resp.data)
+        self.assertIn('"name":"Maciej Z."', resp.data)
+        self.assertIn('dashboard: {', resp.data)
+        self.assertIn(utils.script_json(utils.user_dashboard(11)), resp.data)
+        self.assertIn('chart_pages', utils.CACHE)
+        self.assertEqual(
+            self.client.get('/chart/presence_start_end?user_id=11').data,
+            resp.data)
+        self.assertEqual(utils.HITS['chart_pages'], 1)
+
+        resp = self.client.get('/chart/presence_start_end?user_id=99')
+        self.assertIn('dashboard: null', resp.data)
+        self.assertEqual(
+            utils.script_json(['</script>']), '["<\\/script>"]')
 
     def test_mean_time_weekday(self):
         """
@@ -101,6 +174,9 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
              u'name': u'Maciej Z.'}
             ])
 
+        resp = self.client.get('/api/v2/users?present=1')
+        self.assertEqual(json.loads(resp.data), data)
+
     def test_mean_time_weekday_view(self):
         """
         Test correct return of mean presence time of given user
@@ -204,6 +280,257 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             [u'Sat', 0, 0],
             [u'Sun', 0, 0]])
 
+    def test_columnar_formats(self):
+        """
+        Test content negotiation of columnar response formats.
+        """
+        resp = self.client.get(
+            '/api/v1/presence_start_end/10',
+            headers={'Accept': utils.COLUMNAR_JSON_MIMETYPE})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, utils.COLUMNAR_JSON_MIMETYPE)
+        self.assertIn('Accept', resp.headers['Vary'])
+        data = json.loads(resp.data)
+        self.assertDictEqual(data, {
+            u'weekday': [
+                u'Mon', u'Tue', u'Wed', u'Thu', u'Fri', u'Sat', u'Sun'],
+            u'start': [0, 34745.0, 33592.0, 38926.0, 0, 0, 0],
+            u'end': [0, 64792.0, 58057.0, 62631.0, 0, 0, 0],
+        })
+
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10',
+            headers={'Accept': 'text/html,application/json;q=0.9'})
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual(
+            json.loads(resp.data)[0], [u'Weekday', u'Presence (s)'])
+
+        resp = self.client.get(
+            '/api/v1/presence_weekday/12',
+            headers={'Accept': utils.COLUMNAR_JSON_MIMETYPE})
+        self.assertEqual(json.loads(resp.data), {})
+
+    @unittest.skipIf(utils.msgpack is None, 'msgpack is not installed')
+    def test_msgpack_format(self):
+        """
+        Test msgpack response format.
+        """
+        resp = self.client.get(
+            '/api/v1/mean_time_weekday/11',
+            headers={'Accept': utils.MSGPACK_MIMETYPE})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, utils.MSGPACK_MIMETYPE)
+        data = utils.msgpack.unpackb(resp.data)
+        self.assertEqual(data['mean'], [
+            24123.0, 16564.0, 25321.0, 22984.0, 6426.0, 0, 0])
+        self.assertEqual(len(data['weekday']), 7)
+
+    def test_validation_view(self):
+        """
+        Test validation counts are available to admins only.
+        """
+        resp = self.client.get('/api/admin/validation')
+        self.assertEqual(resp.status_code, 403)
+        main.app.config.update({'ADMIN_TOKEN': 'secret'})
+        try:
+            resp = self.client.get(
+                '/api/admin/validation', headers={'X-Admin-Token': 'bad'})
+            self.assertEqual(resp.status_code, 403)
+            resp = self.client.get(
+                '/api/admin/validation', headers={'X-Admin-Token': 'secret'})
+        finally:
+            main.app.config.pop('ADMIN_TOKEN')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data['rows'], 9)
+        self.assertEqual(data['clean'], 9)
+        self.assertEqual(data['rejected'], {})
+
+    def test_cache_admin_view(self):
+        """
+        Test cache inspection, purge and reload.
+        """
+        headers = {'X-Admin-Token': 'secret'}
+        main.app.config.update({'ADMIN_TOKEN': 'secret'})
+        self.addCleanup(main.app.config.pop, 'ADMIN_TOKEN')
+        self.assertEqual(
+            self.client.get('/api/admin/cache').status_code, 403)
+        self.client.get('/api/v1/mean_time_weekday/10')
+        self.client.get('/api/v1/mean_time_weekday/10')
+
+        resp = self.client.get('/api/admin/cache', headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        entries = json.loads(resp.data)['entries']
+        entries = dict((entry['key'], entry) for entry in entries)
+        self.assertGreater(entries['user_data']['size'], 0)
+        self.assertGreaterEqual(entries['user_data']['age'], 0)
+        self.assertEqual(entries['weekday_series']['hits'], 1)
+        self.assertIsNone(entries['weekday_series']['age'])
+        self.assertGreater(entries['partitions']['size'], 0)
+
+        resp = self.client.delete(
+            '/api/admin/cache?key=user_data', headers=headers)
+        self.assertEqual(json.loads(resp.data), ['user_data'])
+        self.assertNotIn('user_data', utils.CACHE)
+        self.assertIn('weekday_series', utils.CACHE)
+
+        resp = self.client.post(
+            '/api/admin/cache/user_data/reload', headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        for _ in range(100):
+            resp = self.client.get(
+                '/api/admin/cache/user_data/reload', headers=headers)
+            status = json.loads(resp.data)
+            if status['state'] != 'running':
+                break
+            time.sleep(0.05)
+        self.assertEqual(status['state'], 'done')
+        self.assertEqual(status['rows'], 9)
+        self.assertGreaterEqual(status['duration'], 0)
+        self.assertIn('user_data', utils.CACHE)
+
+        resp = self.client.post(
+            '/api/admin/cache/weekday_series/reload', headers=headers)
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get(
+            '/api/admin/cache/users_xml/reload', headers=headers)
+        self.assertEqual(resp.status_code, 404)
+
+        resp = self.client.delete('/api/admin/cache', headers=headers)
+        self.assertIn('weekday_series', json.loads(resp.data))
+        self.assertIn('partitions', json.loads(resp.data))
+        self.assertEqual(utils.CACHE, {})
+        self.assertEqual(utils.PARTITIONS, {})
+
+    def test_rollup_view(self):
+        """
+        Test presence totals per calendar period.
+        """
+        resp = self.client.get('/api/v1/rollup/week/11')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(data, [
+            [u'Period', u'Presence (s)', u'Days', u'Mean (s)'],
+            [u'2013-W36', 22999, 1, 22999.0],
+            [u'2013-W37', 95403, 5, 19080.6],
+        ])
+
+        resp = self.client.get('/api/v1/rollup/month/11')
+        data = json.loads(resp.data)
+        self.assertEqual(data[1][:3], [u'2013-09', 118402, 6])
+
+        resp = self.client.get('/api/v1/rollup/year/team')
+        data = json.loads(resp.data)
+        self.assertEqual(data[1][:3], [u'2013', 196619, 9])
+
+        resp = self.client.get('/api/v1/rollup/year/12')
+        self.assertEqual(json.loads(resp.data), [])
+
+        resp = self.client.get('/api/v1/rollup/decade/11')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_ranking_view(self):
+        """
+        Test users ranked by presence metrics.
+        """
+        resp = self.client.get('/api/v1/ranking/presence')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(data, [
+            [u'User', u'Value', u'Days'],
+            [11, 118402, 6],
+            [10, 78217, 3],
+        ])
+
+        resp = self.client.get('/api/v1/ranking/mean_presence?order=asc')
+        data = json.loads(resp.data)
+        self.assertEqual([row[0] for row in data[1:]], [11, 10])
+
+        resp = self.client.get('/api/v1/ranking/presence?limit=1&weekday=3')
+        data = json.loads(resp.data)
+        self.assertEqual(data[1:], [[11, 45968, 2]])
+        resp = self.client.get('/api/v1/ranking/presence?limit=2&weekday=3')
+        self.assertEqual(len(json.loads(resp.data)), 3)
+        resp = self.client.get('/api/v1/ranking/presence?order=asc&weekday=3')
+        self.assertEqual(json.loads(resp.data)[1][0], 10)
+        self.assertEqual(len(utils.CACHE['rankings']['results']), 3)
+
+        resp = self.client.get(
+            '/api/v1/ranking/presence?since=2013-09-11&until=2013-09-11')
+        data = json.loads(resp.data)
+        self.assertEqual(data[1:], [[11, 25321, 1], [10, 24465, 1]])
+
+        resp = self.client.get('/api/v1/ranking/presence?since=2014-01-01')
+        self.assertEqual(json.loads(resp.data), [])
+
+        resp = self.client.get('/api/v1/ranking/presence?weekday=7')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/ranking/presence?since=yesterday')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/ranking/height')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_anomalies_view(self):
+        """
+        Test days unusual compared with weekday norms of their users.
+        """
+        resp = self.client.get('/api/v1/anomalies')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), [])
+
+        resp = self.client.get(
+            '/api/v1/anomalies?threshold=0.5&min_days=2&since=2013-09-12')
+        data = json.loads(resp.data)
+        self.assertEqual(
+            data[0], [u'User', u'Date', u'Metric', u'Value', u'Mean',
+                      u'Z-score'])
+        self.assertEqual([row[:4] for row in data[1:]], [
+            [11, u'2013-09-12', u'presence', 22969],
+            [11, u'2013-09-12', u'start', 37116],
+            [11, u'2013-09-12', u'end', 60085],
+        ])
+        self.assertEqual(data[1][4], 22984.0)
+        self.assertAlmostEqual(data[1][5], -0.7071, places=4)
+        self.assertAlmostEqual(data[2][5], 0.7071, places=4)
+
+        for threshold in ('0.51', '0.52', '0.5'):
+            self.client.get(
+                '/api/v1/anomalies?min_days=2&threshold=' + threshold)
+        results = utils.CACHE['anomalies']['results']
+        self.assertEqual(len(results), 3)
+        self.assertIn((0.5, 2, None, None), results)
+
+        resp = self.client.get('/api/v1/anomalies?threshold=high')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_user_dashboard_view(self):
+        """
+        Test user metadata and all weekday series in one response.
+        """
+        resp = self.client.get('/api/v2/user/11/dashboard')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertDictEqual(data, {
+            u'user': {
+                u'id': 11,
+                u'avatar': u'https://intranet.stxnext.pl/api/images/users/11',
+                u'name': u'Maciej D.',
+            },
+            u'weekdays': [
+                u'Mon', u'Tue', u'Wed', u'Thu', u'Fri', u'Sat', u'Sun'],
+            u'presence': [24123, 16564, 25321, 45968, 6426, 0, 0],
+            u'mean': [24123.0, 16564.0, 25321.0, 22984.0, 6426.0, 0, 0],
+            u'start': [33134.0, 33590.0, 33206.0, 35602.0, 47816.0, 0, 0],
+            u'end': [57257.0, 50154.0, 58527.0, 58586.0, 54242.0, 0, 0],
+        })
+
+        resp = self.client.get('/api/v2/user/12/dashboard')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), {})
+
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
     """
@@ -217,7 +544,7 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         utils.CACHE = {}
         utils.TIMESTAMPS = {}
         main.app.config.update({
-            'DATA_CSV': TEST_DATA_CSV, 'USERS_XML': TEST_USERS_XML})
+            'DATA_CSV': TEST_DATA_CSV, 'USERS_DATA_XML': TEST_USERS_XML})
 
     def tearDown(self):
         """
@@ -251,6 +578,372 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         new_data = utils.get_data()
         self.assertNotEqual(data, new_data)
 
+    def test_get_data_compressed(self):
+        """
+        Test parsing of gzip and bzip2 compressed CSV files.
+        """
+        data = utils.get_data()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(TEST_DATA_CSV, 'rb') as csvfile:
+                content = csvfile.read()
+            compressed = {
+                'data.csv.gz': gzip.open,
+                'data.csv.bz2': bz2.BZ2File,
+            }
+            for name, opener in compressed.items():
+                path = os.path.join(tmpdir, name)
+                compressed_file = opener(path, 'wb')
+                compressed_file.write(content)
+                compressed_file.close()
+                utils.CACHE = {}
+                utils.TIMESTAMPS = {}
+                main.app.config.update({'DATA_CSV': path})
+                self.assertEqual(utils.get_data(), data)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_get_data_multi_member(self):
+        """
+        Test compressed files concatenated from several parts are read
+        whole.
+        """
+        data = utils.get_data()
+        with open(TEST_DATA_CSV, 'rb') as csvfile:
+            lines = csvfile.readlines()
+        parts = [''.join(lines[:4]), ''.join(lines[4:7]), ''.join(lines[7:])]
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        compressors = {
+            'data.csv.gz': gzip_compress,
+            'data.csv.bz2': bz2.compress,
+        }
+        for name, compress in compressors.items():
+            path = os.path.join(tmpdir, name)
+            content = ''.join(compress(part) for part in parts)
+            with open(path, 'wb') as compressed_file:
+                compressed_file.write(content)
+            utils.CACHE = {}
+            utils.TIMESTAMPS = {}
+            main.app.config.update({'DATA_CSV': path})
+            self.assertEqual(utils.get_data(), data)
+            self.assertEqual(utils.VALIDATION['rows'], 9)
+            new_decompressor = utils.decompressor_factory(content[:4])
+            for chunk_size in (1, 7, len(content)):
+                stream = StringIO(content)
+                self.assertEqual(
+                    list(utils.iter_lines(
+                        stream, new_decompressor, chunk_size=chunk_size)),
+                    lines)
+
+    @unittest.skipIf(utils.zstandard is None, 'zstandard is not installed')
+    def test_get_data_zstd(self):
+        """
+        Test parsing of zstd compressed CSV files of one and many frames.
+        """
+        data = utils.get_data()
+        with open(TEST_DATA_CSV, 'rb') as csvfile:
+            lines = csvfile.readlines()
+        compress = utils.zstandard.ZstdCompressor().compress
+        contents = {
+            'data.csv.zst': compress(''.join(lines)),
+            'parts.csv.zst': ''.join(
+                compress(''.join(part))
+                for part in (lines[:4], lines[4:7], lines[7:])),
+        }
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        for name, content in sorted(contents.items()):
+            path = os.path.join(tmpdir, name)
+            with open(path, 'wb') as compressed_file:
+                compressed_file.write(content)
+            utils.CACHE = {}
+            utils.TIMESTAMPS = {}
+            main.app.config.update({'DATA_CSV': path})
+            self.assertEqual(utils.get_data(), data)
+            self.assertEqual(utils.VALIDATION['rows'], 9)
+            for chunk_size in (1, 7, len(content)):
+                stream = utils.zstd_stream(StringIO(content))
+                self.assertEqual(
+                    list(utils.iter_lines(stream, chunk_size=chunk_size)),
+                    lines)
+
+    def test_get_data_validation(self):
+        """
+        Test invalid rows are quarantined instead of aggregated.
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'data.csv')
+            with open(path, 'w') as csvfile:
+                csvfile.write(
+                    'user_id,date,start,end\n'
+                    '10,2013-09-10,09:39:05,17:59:52\n'
+                    '10,2013-09-11,17:00:00,09:00:00\n'
+                    '10,2013-09-10,09:39:05,17:59:52\n'
+                    '0,2013-09-12,09:00:00,17:00:00\n'
+                    '10,2999-09-12,09:00:00,17:00:00\n'
+                    '11,2013-09-12,09:00\n'
+                    '\n'
+                    '11,2013-09-13,09:00:00,17:00:00\n'
+                )
+            quarantine = os.path.join(tmpdir, 'quarantine.csv')
+            main.app.config.update({
+                'DATA_CSV': path, 'QUARANTINE_CSV': quarantine})
+            data = utils.get_data()
+        finally:
+            main.app.config.pop('QUARANTINE_CSV')
+        try:
+            self.assertItemsEqual(data.keys(), [10, 11])
+            self.assertEqual(data[10].keys(), [datetime.date(2013, 9, 10)])
+            self.assertEqual(utils.VALIDATION['rows'], 8)
+            self.assertEqual(utils.VALIDATION['clean'], 2)
+            self.assertEqual(utils.VALIDATION['rejected'], {
+                'malformed': 2,
+                'end before start': 1,
+                'duplicate': 1,
+                'invalid user id': 1,
+                'date in future': 1,
+            })
+            self.assertEqual(utils.VALIDATION['recheck_on'], '2999-09-12')
+            partition = utils.PARTITIONS[path]
+            self.assertNotIn(
+                'date in future',
+                [reason for _, _, reason in partition['rejected']])
+            self.assertEqual(list(partition['line']), [1, 5, 8])
+            with open(quarantine) as quarantine_file:
+                rows = list(csv.reader(quarantine_file))
+            self.assertEqual(rows[0], [
+                'source', 'line', 'reason',
+                'user_id', 'date', 'start', 'end'])
+            self.assertEqual(set(row[0] for row in rows[1:]), set([path]))
+            self.assertEqual([row[1:] for row in rows[1:]], [
+                ['1', 'malformed', 'user_id', 'date', 'start', 'end'],
+                ['3', 'end before start',
+                 '10', '2013-09-11', '17:00:00', '09:00:00'],
+                ['4', 'duplicate', '10', '2013-09-10', '09:39:05', '17:59:52'],
+                ['5', 'invalid user id',
+                 '0', '2013-09-12', '09:00:00', '17:00:00'],
+                ['6', 'date in future',
+                 '10', '2999-09-12', '09:00:00', '17:00:00'],
+                ['7', 'malformed', '11', '2013-09-12', '09:00'],
+            ])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_get_data_many_sources(self):
+        """
+        Test merging of several presence files.
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            first = os.path.join(tmpdir, 'office_a.csv')
+            second = os.path.join(tmpdir, 'office_b.csv')
+            with open(first, 'w') as csvfile:
+                csvfile.write(
+                    '10,2013-09-10,09:00:00,17:00:00\n'
+                    '10,2013-09-11,09:00:00,17:00:00\n')
+            with open(second, 'w') as csvfile:
+                csvfile.write(
+                    '10,2013-09-11,10:00:00,18:00:00\n'
+                    '11,2013-09-11,08:00:00,16:00:00\n')
+            main.app.config.update({
+                'DATA_CSV': os.path.join(tmpdir, 'office_*.csv')})
+            data = utils.get_data()
+            self.assertItemsEqual(data.keys(), [10, 11])
+            self.assertEqual(
+                data[10][datetime.date(2013, 9, 10)]['start'],
+                datetime.time(9, 0, 0))
+            self.assertEqual(
+                data[10][datetime.date(2013, 9, 11)],
+                {'start': datetime.time(9, 0, 0),
+                 'end': datetime.time(18, 0, 0)})
+            self.assertEqual(utils.VALIDATION['sources'], [first, second])
+
+            partition = utils.PARTITIONS[first]
+            with open(second, 'a') as csvfile:
+                csvfile.write('12,2013-09-11,08:00:00,16:00:00\n')
+            os.utime(second, (0, 0))
+            data = utils.get_data()
+            self.assertItemsEqual(data.keys(), [10, 11, 12])
+            self.assertIs(utils.PARTITIONS[first], partition)
+
+            third = os.path.join(tmpdir, 'office_c.csv')
+            with open(third, 'w') as csvfile:
+                csvfile.write('13,2013-09-11,08:00:00,16:00:00\n')
+            self.assertItemsEqual(utils.get_data().keys(), [10, 11, 12, 13])
+
+            main.app.config.update({'DATA_CSV': [first, TEST_DATA_CSV]})
+            utils.purge_cache('user_data')
+            self.assertItemsEqual(utils.get_data().keys(), [10, 11])
+            self.assertNotIn(second, utils.PARTITIONS)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_get_data_sessions(self):
+        """
+        Test many work sessions per day are kept.
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'data.csv')
+            with open(path, 'w') as csvfile:
+                csvfile.write(
+                    '10,2013-09-10,13:00:00,17:00:00\n'
+                    '10,2013-09-10,08:00:00,12:00:00\n'
+                    '10,2013-09-10,11:00:00,12:30:00\n'
+                    '10,2013-09-11,08:00:00,12:00:00\n')
+            main.app.config.update({'DATA_CSV': path})
+            sessions = utils.get_data()[10]
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(list(sessions.sessions()), [
+            (735121, 28800, 45000),
+            (735121, 46800, 61200),
+            (735122, 28800, 43200),
+        ])
+        self.assertEqual(sessions[datetime.date(2013, 9, 10)], {
+            'start': datetime.time(8, 0, 0), 'end': datetime.time(17, 0, 0)})
+        self.assertEqual(len(sessions), 2)
+        self.assertEqual(utils.group_by_weekday(sessions)[1], [30600])
+        self.assertEqual(
+            utils.mean_group_by_weekday_seconds(sessions)[1],
+            {'start': [28800], 'end': [61200]})
+
+    def test_running_stats(self):
+        """
+        Test running mean and variance match the ones of whole sample.
+        """
+        values = [28800, 27000, 30600, 29100, 7200]
+        stats = anomalies.RunningStats()
+        for value in values:
+            stats.add(value)
+        self.assertEqual(stats.count, 5)
+        self.assertAlmostEqual(stats.mean, utils.mean(values))
+        variance = sum((value - stats.mean) ** 2 for value in values) / 4
+        self.assertAlmostEqual(stats.std ** 2, variance, places=3)
+        self.assertLess(stats.zscore(7200), -1.5)
+        self.assertIsNone(anomalies.RunningStats().zscore(1))
+
+    def test_user_directory(self):
+        """
+        Test users.xml is joined with presence data by dense index.
+        """
+        ids = registry.IdRegistry()
+        ids.register([141, 10])
+        users = [
+            {u'id': 141, u'name': u'Anna K.', u'avatar': None},
+            {u'id': 11, u'name': u'Maciej D.', u'avatar': None},
+        ]
+        directory = registry.UserDirectory(ids, users, {10: [], 11: []})
+        self.assertEqual(list(ids.ids), [10, 141, 11])
+        self.assertEqual(ids.index(11), 2)
+        self.assertIsNone(ids.index(26))
+        self.assertEqual(list(directory.present), [1, 0, 1])
+        self.assertIsNone(directory.user(10))
+        self.assertIsNone(directory.user(26))
+        self.assertEqual(directory.user(141), users[0])
+        self.assertEqual(directory.listing(), users)
+        self.assertEqual(directory.listing(present=True), users[1:])
+
+    def test_memorize_generation_bounded(self):
+        """
+        Test derived results are kept in bounded LRU, without None ones.
+        """
+        calls = []
+
+        @utils.memorize_generation('test_squares', utils.get_data, maxsize=2)
+        def square(number):
+            """
+            Squares known numbers.
+            """
+            calls.append(number)
+            return number * number if number < 10 else None
+
+        self.assertEqual([square(i) for i in (1, 2, 1, 3)], [1, 4, 1, 9])
+        self.assertEqual(calls, [1, 2, 3])
+        results = utils.CACHE['test_squares']['results']
+        self.assertEqual(results.keys(), [(1,), (3,)])
+        for _ in range(3):
+            self.assertIsNone(square(11))
+        self.assertNotIn((11,), results)
+        self.assertEqual(utils.HITS['test_squares'], 1)
+
+    def test_iter_lines(self):
+        """
+        Test splitting stream chunks into lines.
+        """
+        with open(TEST_DATA_CSV, 'rb') as csvfile:
+            expected = csvfile.readlines()
+        with open(TEST_DATA_CSV, 'rb') as csvfile:
+            lines = list(utils.iter_lines(csvfile, chunk_size=7))
+        self.assertEqual(lines, expected)
+
+    def test_cache_source_changed(self):
+        """
+        Test cached data is invalidated when its source file changes.
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'data.csv')
+            shutil.copy(TEST_DATA_CSV, path)
+            main.app.config.update({'DATA_CSV': path})
+            self.assertItemsEqual(utils.get_data().keys(), [10, 11])
+            with open(path, 'a') as csvfile:
+                csvfile.write('\n12,2013-09-10,09:00:00,17:00:00\n')
+            os.utime(path, (0, 0))
+            self.assertItemsEqual(utils.get_data().keys(), [10, 11, 12])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_memorize_data_refresh(self):
+        """
+        Test refresh swaps data in without lock and purged data is reloaded.
+        """
+        calls = []
+
+        @utils.memorize_data('test_refresh', 3600)
+        def load():
+            """
+            Counts loads.
+            """
+            calls.append(utils.CACHE.get('test_refresh'))
+            return len(calls)
+
+        self.assertEqual(load(), 1)
+        generation = utils.GENERATIONS['test_refresh']
+        with utils.LOCKER:
+            self.assertEqual(load.refresh(), 2)
+        self.assertEqual(calls, [None, 1])
+        self.assertEqual(load(), 2)
+        self.assertEqual(utils.GENERATIONS['test_refresh'], generation + 1)
+        utils.TIMESTAMPS['test_refresh'] = time.time()
+        utils.CACHE.pop('test_refresh')
+        self.assertEqual(load(), 3)
+
+    def test_memorize_generation(self):
+        """
+        Test derived data is cached until its source data is reloaded.
+        """
+        calls = []
+
+        @utils.memorize_generation('test_generation', utils.get_data)
+        def users_count(offset):
+            """
+            Counts users.
+            """
+            calls.append(offset)
+            return len(utils.get_data()) + offset
+
+        self.assertEqual(users_count(0), 2)
+        self.assertEqual(users_count(0), 2)
+        self.assertEqual(users_count(1), 3)
+        self.assertEqual(calls, [0, 1])
+        main.app.config.update({'DATA_CSV': TEST_CACHE_DATA})
+        utils.purge_cache('user_data')
+        self.assertNotEqual(users_count(0), 2)
+        self.assertEqual(calls, [0, 1, 0])
+
     def test_group_by_weekday(self):
         """
         Testing groups presence entries by weekday
@@ -276,7 +969,7 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             0: [24123],
             1: [16564],
             2: [25321],
-            3: [22969, 22999],
+            3: [22999, 22969],
             4: [6426],
             5: [],
             6: [],
@@ -307,7 +1000,7 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             0: {'end': [57257], 'start': [33134]},
             1: {'end': [50154], 'start': [33590]},
             2: {'end': [58527], 'start': [33206]},
-            3: {'end': [60085, 57087], 'start': [37116, 34088]},
+            3: {'end': [57087, 60085], 'start': [34088, 37116]},
             4: {'end': [54242], 'start': [47816]},
             5: {'end': [], 'start': []},
             6: {'end': [], 'start': []}
@@ -364,6 +1057,8 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertEqual(utils.interval(
             datetime.time(12, 00, 00),
             datetime.time(05, 00, 00)), -25200)
+        self.assertEqual(utils.interval([28800, 46800], [43200, 61200]), 28800)
+        self.assertEqual(utils.interval([], []), 0)
 
     def test_mean(self):
         """
@@ -380,6 +1075,564 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertEqual(utils.mean([25200, 3600, 1800, 100]), 7675)
 
 
+class UsersXmlHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Local stand-in for users.xml feed.
+    """
+    body = ''
+    etag = '"v1"'
+    requests = []
+
+    def do_GET(self):  # pylint: disable=C0103
+        """
+        Serves feed, honouring If-None-Match header.
+        """
+        self.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Last-Modified', 'Mon, 07 Oct 2013 10:00:00 GMT')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        """
+        Keeps test output clean.
+        """
+        pass
+
+
+class PresenceAnalyzerImportTestCase(unittest.TestCase):
+    """
+    Users XML importer tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, start local feed server.
+        """
+        with open(TEST_USERS_XML, 'rb') as xmlfile:
+            UsersXmlHandler.body = xmlfile.read()
+        UsersXmlHandler.requests = []
+        self.server = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), UsersXmlHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'users.xml')
+        main.app.config.update({
+            'USERS_DATA_XML': self.path,
+            'USERS_DATA_XML_URL': 'http://127.0.0.1:{}/users.xml'.format(
+                self.server.server_port),
+        })
+
+    def tearDown(self):
+        """
+        Stop feed server and remove imported files.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+        main.app.config.update({'USERS_DATA_XML': TEST_USERS_XML})
+
+    def test_import_conditional(self):
+        """
+        Test unchanged feed is not downloaded again.
+        """
+        self.assertTrue(utils.import_user_xml_form_url())
+        with open(self.path, 'rb') as xmlfile:
+            self.assertEqual(xmlfile.read(), UsersXmlHandler.body)
+        self.assertFalse(utils.import_user_xml_form_url())
+        headers = UsersXmlHandler.requests[-1]
+        self.assertEqual(headers['if-none-match'], '"v1"')
+        self.assertEqual(
+            headers['if-modified-since'], 'Mon, 07 Oct 2013 10:00:00 GMT')
+        self.assertItemsEqual(
+            os.listdir(self.tmpdir), ['users.xml', 'users.xml.meta'])
+
+    def test_import_malformed(self):
+        """
+        Test malformed feed does not replace imported users.xml.
+        """
+        utils.import_user_xml_form_url()
+        UsersXmlHandler.body = '<intranet><users>'
+        UsersXmlHandler.etag = '"v2"'
+        try:
+            self.assertRaises(Exception, utils.import_user_xml_form_url)
+        finally:
+            UsersXmlHandler.etag = '"v1"'
+        with open(self.path, 'rb') as xmlfile:
+            with open(TEST_USERS_XML, 'rb') as expected:
+                self.assertEqual(xmlfile.read(), expected.read())
+        self.assertItemsEqual(
+            os.listdir(self.tmpdir), ['users.xml', 'users.xml.meta'])
+
+    def test_schedule_import(self):
+        """
+        Test background importer runs until stopped.
+        """
+        importer = utils.schedule_users_xml_import(0.01)
+        try:
+            for _ in range(100):
+                if len(UsersXmlHandler.requests) > 1:
+                    break
+                threading.Event().wait(0.01)
+        finally:
+            importer.stop.set()
+            importer.join(5)
+        self.assertFalse(importer.is_alive())
+        self.assertGreater(len(UsersXmlHandler.requests), 1)
+        self.assertTrue(os.path.exists(self.path))
+
+
+class PresenceAnalyzerMiddlewareTestCase(unittest.TestCase):
+    """
+    Compression middleware tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, wrap application with middleware.
+        """
+        utils.CACHE = {}
+        utils.TIMESTAMPS = {}
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV, 'USERS_DATA_XML': TEST_USERS_XML})
+        self.static_folder = tempfile.mkdtemp()
+        shutil.copytree(
+            os.path.join(main.app.static_folder, 'css'),
+            os.path.join(self.static_folder, 'css'))
+        self.client = Client(
+            middleware.CompressionMiddleware(
+                main.app.wsgi_app, main.app.static_url_path,
+                self.static_folder, min_size=100),
+            BaseResponse)
+
+    def tearDown(self):
+        """
+        Get rid of precompressed files.
+        """
+        shutil.rmtree(self.static_folder)
+
+    def test_compress_dynamic(self):
+        """
+        Test JSON responses are compressed for accepting clients.
+        """
+        plain = self.client.get('/api/v1/presence_start_end/11')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(plain.headers['Vary'], 'Accept, Accept-Encoding')
+
+        resp = self.client.get(
+            '/api/v1/presence_start_end/11',
+            headers={'Accept-Encoding': 'deflate, gzip'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Vary'], 'Accept, Accept-Encoding')
+        self.assertEqual(
+            int(resp.headers['Content-Length']), len(resp.data))
+        body = gzip.GzipFile(fileobj=StringIO(resp.data)).read()
+        self.assertEqual(body, plain.data)
+
+        resp = self.client.get(
+            '/api/v1/presence_weekday/12',
+            headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+        resp = self.client.get(
+            '/api/v1/presence_start_end/11',
+            headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_precompressed_static(self):
+        """
+        Test static files are served from precompressed copies.
+        """
+        middleware.precompress_static(self.static_folder)
+        path = os.path.join(self.static_folder, 'css', 'normalize.css')
+        self.assertTrue(os.path.exists(path + '.gz'))
+        resp = self.client.get(
+            '/static/css/normalize.css', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(resp.headers['Cache-Control'], 'public, max-age=0')
+        self.assertEqual(resp.headers['Content-Type'], 'text/css')
+        with open(path, 'rb') as css_file:
+            self.assertEqual(
+                gzip.GzipFile(fileobj=StringIO(resp.data)).read(),
+                css_file.read())
+
+        resp = self.client.get(
+            '/static/css/normalize.css?v=1',
+            headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(
+            resp.headers['Cache-Control'], 'public, max-age=31536000')
+
+        resp = self.client.get(
+            '/static/css/normalize.css', headers={
+                'Accept-Encoding': 'gzip',
+                'If-Modified-Since': resp.headers['Last-Modified'],
+            })
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+
+        resp = self.client.get(
+            '/static/../tests.py', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotEqual(resp.headers.get('Cache-Control'),
+                            'public, max-age=31536000')
+
+
+class PresenceAnalyzerServerTestCase(unittest.TestCase):
+    """
+    Pre-forking server tests.
+    """
+
+    def test_recycle_workers(self):
+        """
+        Test workers are replaced after serving max_requests.
+        """
+        def pid_app(environ, start_response):
+            """
+            Responds with pid of serving process.
+            """
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [str(os.getpid())]
+
+        prefork = server.PreforkServer(
+            pid_app, '127.0.0.1', 0, processes=1, max_requests=2)
+        thread = threading.Thread(target=prefork.serve_forever)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:{}/'.format(prefork.port)
+            pids = [urllib2.urlopen(url).read() for _ in range(4)]
+        finally:
+            prefork.stop()
+            thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertNotIn(str(os.getpid()), pids)
+        self.assertEqual(len(set(pids)), 2)
+        self.assertEqual(pids[0], pids[1])
+
+    def test_orphaned_workers_exit(self):
+        """
+        Test workers and tasks exit once master process is gone.
+        """
+        def pid_app(environ, start_response):
+            """
+            Responds with pid of serving process.
+            """
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [str(os.getpid())]
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        task_pid = os.path.join(tmpdir, 'task.pid')
+
+        def task():
+            """
+            Records pid of task process.
+            """
+            with open(task_pid, 'w') as pid_file:
+                pid_file.write(str(os.getpid()))
+
+        old_interval = server.MASTER_CHECK_INTERVAL
+        server.MASTER_CHECK_INTERVAL = 0.05
+        self.addCleanup(setattr, server, 'MASTER_CHECK_INTERVAL', old_interval)
+        prefork = server.PreforkServer(
+            pid_app, '127.0.0.1', 0, processes=1, tasks=[task])
+        master = os.fork()
+        if not master:
+            try:
+                prefork.serve_forever()
+            finally:
+                os._exit(0)  # pylint: disable-msg=W0212
+        prefork.server.server_close()
+        url = 'http://127.0.0.1:{}/'.format(prefork.port)
+        worker = int(urllib2.urlopen(url).read())
+        for _ in range(100):
+            if os.path.exists(task_pid):
+                break
+            time.sleep(0.05)
+        with open(task_pid) as pid_file:
+            pids = [worker, int(pid_file.read())]
+        os.kill(master, signal.SIGKILL)
+        os.waitpid(master, 0)
+
+        def running(pid):
+            """
+            Checks if process runs, zombies of exited ones do not count.
+            """
+            try:
+                with open('/proc/{}/stat'.format(pid)) as stat:
+                    return stat.read().split(') ')[1][0] != 'Z'
+            except IOError:
+                return False
+
+        for _ in range(100):
+            if not any(running(pid) for pid in pids):
+                break
+            time.sleep(0.05)
+        self.assertFalse(any(running(pid) for pid in pids))
+
+
+class PresenceAnalyzerLoadTestTestCase(unittest.TestCase):
+    """
+    Load-test harness tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        utils.CACHE = {}
+        utils.TIMESTAMPS = {}
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV, 'USERS_DATA_XML': TEST_USERS_XML})
+
+    def test_request_paths(self):
+        """
+        Test request paths are drawn from profile and skewed user ids.
+        """
+        users = loadtest.user_weights([10, 11, 12], skew=2.0, seed=1)
+        self.assertEqual(sorted(user for _, user in users), [10, 11, 12])
+        self.assertEqual(users[0][0], 1.0)
+        self.assertEqual(users[1][0], 0.25)
+        paths = loadtest.request_paths(
+            loadtest.DEFAULT_PROFILE, users, 200, seed=1)
+        self.assertEqual(
+            paths, loadtest.request_paths(
+                loadtest.DEFAULT_PROFILE, users, 200, seed=1))
+        counts = Counter(path.rsplit('/', 1)[-1] for path in paths)
+        self.assertGreater(counts[str(users[0][1])], counts[str(users[2][1])])
+        self.assertIn('/api/v1/users', paths)
+
+    def test_read_profile(self):
+        """
+        Test profile is read from JSON or recorded from access log.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'profile')
+        with open(path, 'w') as profile_file:
+            profile_file.write('[[3, "/api/v1/users"]]')
+        self.assertEqual(
+            loadtest.read_profile(path), [(3, '/api/v1/users')])
+        with open(path, 'w') as profile_file:
+            for user_id in (10, 11, 10):
+                profile_file.write(
+                    '127.0.0.1 - - [10/Sep/2013:09:39:05 +0200] '
+                    '"GET /api/v1/presence_weekday/{} HTTP/1.1" 200 '
+                    '154\n'.format(user_id))
+        self.assertEqual(loadtest.read_profile(path), [
+            (2, '/api/v1/presence_weekday/10'),
+            (1, '/api/v1/presence_weekday/11'),
+        ])
+
+    def test_percentile(self):
+        """
+        Test nearest-rank percentiles.
+        """
+        values = range(1, 101)
+        self.assertEqual(loadtest.percentile(values, 0.5), 50)
+        self.assertEqual(loadtest.percentile(values, 0.99), 99)
+        self.assertEqual(loadtest.percentile([7], 0.95), 7)
+        self.assertIsNone(loadtest.percentile([], 0.5))
+
+    def test_measure(self):
+        """
+        Test cold and warm runs against local instance.
+        """
+        paths = ['/api/v1/users', '/api/v1/presence_weekday/10',
+                 '/api/v1/missing'] * 4
+        with loadtest.LocalInstance(main.app, processes=1) as instance:
+            results = loadtest.measure(
+                instance.url, paths, 3, cold=lambda: None)
+        self.assertEqual([result['cache'] for result in results],
+                         ['cold', 'warm'])
+        for result in results:
+            self.assertEqual(result['requests'], 12)
+            self.assertEqual(result['errors'], {404: 4})
+            self.assertLessEqual(result['p50'], result['p99'])
+        self.assertIn('warm', loadtest.format_report(results))
+
+
+class PresenceAnalyzerStorageTestCase(unittest.TestCase):
+    """
+    Month partitioned storage tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, configure empty storage.
+        """
+        utils.CACHE = {}
+        utils.TIMESTAMPS = {}
+        self.directory = tempfile.mkdtemp()
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'USERS_DATA_XML': TEST_USERS_XML,
+            'STORAGE_DIR': self.directory,
+        })
+
+    def tearDown(self):
+        """
+        Get rid of storage.
+        """
+        main.app.config.pop('STORAGE_DIR')
+        main.app.config.pop('STORAGE_MEMORY_BUDGET', None)
+        shutil.rmtree(self.directory)
+        utils.CACHE = {}
+        utils.TIMESTAMPS = {}
+
+    def test_get_data_storage(self):
+        """
+        Test storage behaves like in-memory presence data.
+        """
+        store = utils.get_data()
+        self.assertIsInstance(store, storage.PresenceStore)
+        main.app.config.pop('STORAGE_DIR')
+        utils.purge_cache('user_data')
+        data = utils.get_data()
+        main.app.config['STORAGE_DIR'] = self.directory
+        self.assertEqual(store.keys(), [10, 11])
+        self.assertIn(10, store)
+        self.assertNotIn(12, store)
+        self.assertEqual(dict((key, store[key]) for key in store), data)
+
+        utils.PARTITIONS.clear()
+        utils.purge_cache('user_data')
+        reopened = utils.get_data()
+        self.assertIsNot(reopened, store)
+        self.assertEqual(utils.PARTITIONS, {})
+        self.assertEqual(reopened[11], data[11])
+        self.assertEqual(utils.VALIDATION['clean'], 9)
+
+        client = main.app.test_client()
+        resp = client.get('/api/v1/presence_weekday/11')
+        self.assertEqual(json.loads(resp.data)[4], [u'Thu', 45968])
+
+    def test_storage_recheck_future_rows(self):
+        """
+        Test store is rebuilt once rows rejected as future become valid.
+        """
+        store = utils.get_data()
+        manifest = storage.read_manifest(self.directory)
+        manifest['extra']['validation']['recheck_on'] = '2013-01-01'
+        storage.write_atomic(
+            os.path.join(self.directory, storage.MANIFEST),
+            json.dumps(manifest))
+        utils.purge_cache('user_data')
+        rebuilt = utils.get_data()
+        self.assertIsNot(rebuilt, store)
+        self.assertIsNone(
+            rebuilt.manifest['extra']['validation']['recheck_on'])
+
+    def test_concurrent_builds(self):
+        """
+        Test builds are serialized and keep recent files of other builds.
+        """
+        data = {10: utils.UserSessions([735121], [3600], [7200])}
+        sources = [('data.csv', 1, 1)]
+        first = storage.build_store(self.directory, sources, data, 1024)
+        for _ in range(2):
+            storage.build_store(self.directory, sources, data, 1024)
+        self.assertEqual(first[10], data[10])
+
+        acquired = threading.Event()
+
+        def build():
+            """
+            Waits for the lock held by the test.
+            """
+            with storage.build_lock(self.directory):
+                acquired.set()
+
+        with storage.build_lock(self.directory):
+            thread = threading.Thread(target=build)
+            thread.start()
+            self.assertFalse(acquired.wait(0.2))
+        thread.join(5)
+        self.assertTrue(acquired.is_set())
+
+        old_grace, storage.GRACE_PERIOD = storage.GRACE_PERIOD, -1
+        self.addCleanup(setattr, storage, 'GRACE_PERIOD', old_grace)
+        storage.build_store(self.directory, sources, data, 1024)
+        files = [name for name in os.listdir(self.directory)
+                 if name.endswith('.bin')]
+        self.assertEqual(len(files), 2)
+
+    def test_lazy_partitions(self):
+        """
+        Test partitions are loaded on first touch and evicted LRU.
+        """
+        path = os.path.join(self.directory, 'data.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write(
+                '10,2013-07-10,09:00:00,17:00:00\n'
+                '10,2013-08-10,09:00:00,17:00:00\n'
+                '10,2013-09-10,09:00:00,17:00:00\n'
+                '11,2013-09-11,09:00:00,17:00:00\n')
+        main.app.config.update({
+            'DATA_CSV': path, 'STORAGE_MEMORY_BUDGET': 2 * storage.ROW_SIZE})
+        store = utils.get_data()
+        self.assertEqual(store.loaded.keys(), [])
+        self.assertEqual(store[11].keys(), [datetime.date(2013, 9, 11)])
+        self.assertEqual(store.loaded.keys(), ['2013-09'])
+        recent = store.user_data(10, since=datetime.date(2013, 8, 1))
+        self.assertItemsEqual(
+            recent.keys(),
+            [datetime.date(2013, 8, 10), datetime.date(2013, 9, 10)])
+        self.assertEqual(store.loaded.keys(), ['2013-09'])
+        self.assertEqual(len(store[10]), 3)
+        self.assertLessEqual(store.loaded_bytes, 2 * storage.ROW_SIZE)
+
+    def test_scan_partitions(self):
+        """
+        Test full passes read each partition once, whatever the budget.
+        """
+        path = os.path.join(self.directory, 'data.csv')
+        with open(path, 'w') as csvfile:
+            for month in (7, 8, 9):
+                for user_id in (10, 11):
+                    csvfile.write('{},2013-{:02d}-1{},09:00:00,17:00:00\n'
+                                  .format(user_id, month, user_id - 10))
+        main.app.config.update({
+            'DATA_CSV': path, 'STORAGE_MEMORY_BUDGET': storage.ROW_SIZE})
+        store = utils.get_data()
+        data = dict((key, store[key]) for key in store)
+        store.loaded.clear()
+        reads = []
+        read = storage.MonthPartition.read
+
+        def counting_read(path):
+            """
+            Counts partition reads.
+            """
+            reads.append(path)
+            return read(path)
+
+        storage.MonthPartition.read = staticmethod(counting_read)
+        self.addCleanup(setattr, storage.MonthPartition, 'read', read)
+        self.assertEqual(
+            sorted(utils.daily_presence(store)),
+            sorted(utils.daily_presence(data)))
+        self.assertEqual(len(reads), 3)
+
+        del reads[:]
+        since = datetime.date(2013, 9, 11)
+        store.loaded.clear()
+        days = list(utils.daily_presence(store, since=since))
+        self.assertEqual(len(reads), 1)
+        self.assertTrue(all(row[1] >= since for row in days))
+        self.assertEqual(
+            sorted(days), sorted(utils.daily_presence(data, since=since)))
+
+
 def suite():
     """
     Default test suite.
@@ -387,6 +1640,11 @@ def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerImportTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerMiddlewareTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerServerTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerLoadTestTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerStorageTestCase))
     return suite
 
 
@@ -3,25 +3,80 @@
 Helper functions used in views.
 """
 
+import os
+import bz2
 import csv
+import glob
+import hmac
+import zlib
+import calendar
+import sys
 import time
-import urllib
+import shutil
 import locale
+import urllib2
+import tempfile
 import logging
 import threading
-from json import dumps
+# datetime.strptime imports it lazily, which is not thread safe
+import _strptime  # pylint: disable-msg=W0611
+from array import array
+from json import dumps, load
 from lxml import etree
+from bisect import bisect_left, bisect_right
 from functools import wraps
-from flask import Response
-from datetime import datetime
+from itertools import izip
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from flask import Response, abort, request
+from datetime import date, datetime, time as datetime_time
+from email.utils import formatdate
 from presence_analyzer.main import app
+from presence_analyzer import storage
+from presence_analyzer.sessions import UserSessions, seconds_to_time
+from presence_analyzer.rollups import Rollups
+from presence_analyzer.rankings import UserAggregates, rank, score
+from presence_analyzer.anomalies import Norms
+from presence_analyzer.registry import IdRegistry, UserDirectory
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # pylint: disable-msg=C0103
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None  # pylint: disable-msg=C0103
 
 
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
 CACHE = {}
 TIMESTAMPS = {}
+SOURCES = {}
+GENERATIONS = {}
+VALIDATION = {}
+PARTITIONS = {}
+PARTITIONS_KEY = 'partitions'
+HITS = Counter()
+LOADERS = {}
+RELOADS = {}
+REGISTRY = IdRegistry()
 LOCKER = threading.Lock()
+CACHE_LOCKER = threading.Lock()
+MISSING = object()
+
+GENERATION_CACHE_SIZE = 256
+RANKING_LIMIT = 1000
+
+CHUNK_SIZE = 64 * 1024
+ZSTD_MAGIC = '\x28\xb5\x2f\xfd'
+
+JSON_MIMETYPE = 'application/json'
+COLUMNAR_JSON_MIMETYPE = 'application/vnd.presence-analyzer.columnar+json'
+MSGPACK_MIMETYPE = 'application/x-msgpack'
 
 
 def jsonify(function):
@@ -33,11 +88,70 @@ def jsonify(function):
         """
         Response function
         """
-        return Response(dumps(function(*args, **kwargs)),
+        return Response(dumps(function(*args, **kwargs),
+                              separators=(',', ':')),
                         mimetype='application/json')
     return inner
 
 
+def columnar(header=None):
+    """
+    Creates a response from columns returned by wrapped function.
+
+    Wrapped function returns list of (name, values) pairs. Columns are
+    serialized as they are when `Accept` header asks for columnar JSON or
+    msgpack, otherwise JSON list of rows (preceded by `header`) is sent.
+    """
+    def wraps_function(function):
+        """
+        Fix name and doc function for better debugging.
+        """
+        @wraps(function)
+        def inner(*args, **kwargs):
+            """
+            Response function
+            """
+            columns = function(*args, **kwargs)
+            mimetypes = [JSON_MIMETYPE, COLUMNAR_JSON_MIMETYPE]
+            if msgpack is not None:
+                mimetypes.append(MSGPACK_MIMETYPE)
+            mimetype = request.accept_mimetypes.best_match(
+                mimetypes, JSON_MIMETYPE)
+            if mimetype == MSGPACK_MIMETYPE:
+                body = msgpack.packb(OrderedDict(columns))
+            elif mimetype == COLUMNAR_JSON_MIMETYPE:
+                body = dumps(OrderedDict(columns), separators=(',', ':'))
+            else:
+                rows = zip(*[values for _, values in columns])
+                if rows and header is not None:
+                    rows.insert(0, header)
+                body = dumps(rows, separators=(',', ':'))
+            response = Response(body, mimetype=mimetype)
+            response.vary.add('Accept')
+            return response
+        return inner
+    return wraps_function
+
+
+def admin_required(function):
+    """
+    Allows access only to requests with valid `X-Admin-Token` header.
+
+    Access is denied to everyone while ADMIN_TOKEN is not configured.
+    """
+    @wraps(function)
+    def inner(*args, **kwargs):
+        """
+        Check admin token.
+        """
+        token = app.config.get('ADMIN_TOKEN')
+        given = request.headers.get('X-Admin-Token', '')
+        if not token or not hmac.compare_digest(str(token), str(given)):
+            abort(403)
+        return function(*args, **kwargs)
+    return inner
+
+
 def locker(function):
     """
     Creates locking function decorator.
@@ -52,76 +166,511 @@ def locker(function):
     return inner_locker
 
 
-def memorize_data(key, cache_time):
+def purge_cache(*keys):
+    """
+    Removes given keys (all keys when none are given) from cache, so they
+    are reloaded on next access. PARTITIONS_KEY stands for parsed
+    partitions of presence files. Returns removed keys.
+    """
+    with CACHE_LOCKER:
+        if not keys:
+            keys = list(CACHE) + ([PARTITIONS_KEY] if PARTITIONS else [])
+        keys = sorted(keys)
+        for key in keys:
+            if key == PARTITIONS_KEY:
+                PARTITIONS.clear()
+            CACHE.pop(key, None)
+            TIMESTAMPS.pop(key, None)
+            SOURCES.pop(key, None)
+            HITS.pop(key, None)
+    return keys
+
+
+def file_signature(path):
+    """
+    Identifies version of file by its path, modification time and size.
+    """
+    stat = os.stat(path)
+    return path, stat.st_mtime, stat.st_size
+
+
+def data_files(sources):
+    """
+    Expands path, glob pattern or list of them into sorted list of files.
+    """
+    if isinstance(sources, basestring):
+        sources = [sources]
+    paths = set()
+    for source in sources:
+        if glob.has_magic(source):
+            paths.update(glob.glob(source))
+        else:
+            paths.add(source)
+    return sorted(paths)
+
+
+def sources_signature(sources):
+    """
+    Identifies version of all files given sources expand to.
+    """
+    return tuple(file_signature(path) for path in data_files(sources))
+
+
+def source_changed(key):
+    """
+    Checks if files cached data was loaded from have changed since.
+    """
+    entry = SOURCES.get(key)
+    if entry is None:
+        return False
+    sources, signature = entry
+    try:
+        return sources_signature(sources) != signature
+    except OSError:
+        return True
+
+
+def memorize_data(key, cache_time, source=None):
     """
     Caching decorator to global variable.
+
+    When `source` callable is given, it should return path, glob pattern
+    or list of them data is loaded from. Cached data is then also
+    invalidated as soon as any of those files changes, appears or
+    disappears.
+
+    Decorated function gets `refresh` attribute, which loads data anew
+    and only then replaces the cached one, so it keeps being served in
+    the meantime.
     """
     def wraps_function(function):
         """
         Fix name and doc function for better debugging.
         """
+        def refresh(*args, **kwargs):
+            """
+            Loads data and swaps it into cache.
+            """
+            sources = signature = None
+            if source is not None:
+                sources = source()
+                signature = sources_signature(sources)
+            result = function(*args, **kwargs)
+            with CACHE_LOCKER:
+                CACHE[key] = result
+                TIMESTAMPS[key] = time.time()
+                if source is not None:
+                    SOURCES[key] = sources, signature
+                # derived results must not be cached under new generation
+                # before new data is in place
+                GENERATIONS[key] = GENERATIONS.get(key, 0) + 1
+            return result
+
         @wraps(function)
         def inner_function(*args, **kwargs):
             """
             Inner function, cache function data and set cache timer.
             """
             timestamp = TIMESTAMPS.get(key, 0)
-            if cache_time + timestamp > time.time():
-                return CACHE[key]
-            result = function(*args, **kwargs)
-            CACHE[key] = result
-            TIMESTAMPS[key] = time.time()
+            if cache_time + timestamp > time.time() \
+                    and not source_changed(key):
+                # data may have been purged since the check
+                result = CACHE.get(key, MISSING)
+                if result is not MISSING:
+                    HITS[key] += 1
+                    return result
+            return refresh(*args, **kwargs)
+        inner_function.cache_key = key
+        inner_function.refresh = refresh
+        return inner_function
+    return wraps_function
+
+
+def memorize_generation(key, *loaders, **options):
+    """
+    Caching decorator for data derived from other cached data.
+
+    Results are cached per arguments until any of `loaders` (functions
+    decorated with `memorize_data`) reloads its data. Only `maxsize`
+    (keyword option) most recently used results are kept. None results,
+    e.g. of unknown users, are not cached.
+    """
+    maxsize = options.get('maxsize', GENERATION_CACHE_SIZE)
+
+    def wraps_function(function):
+        """
+        Fix name and doc function for better debugging.
+        """
+        @wraps(function)
+        def inner_function(*args):
+            """
+            Inner function, cache function result per dataset generation.
+            """
+            for loader in loaders:
+                loader()
+            keys = tuple(loader.cache_key for loader in loaders)
+            generation = tuple(GENERATIONS.get(name, 0) for name in keys)
+            with CACHE_LOCKER:
+                entry = CACHE.get(key)
+                if entry is None or entry['generation'] != generation:
+                    entry = CACHE[key] = {
+                        'generation': generation,
+                        'keys': keys,
+                        'results': OrderedDict(),
+                    }
+                results = entry['results']
+                if args in results:
+                    HITS[key] += 1
+                    results[args] = result = results.pop(args)
+                    return result
+            result = function(*args)
+            if result is not None:
+                with CACHE_LOCKER:
+                    results[args] = result
+                    while len(results) > maxsize:
+                        results.popitem(last=False)
             return result
         return inner_function
     return wraps_function
 
 
+def decompressor_factory(header):
+    """
+    Returns function creating streaming decompressor matching file header
+    magic number.
+
+    Returns None for uncompressed and zstd files, see `zstd_stream`.
+    """
+    if header.startswith('\x1f\x8b'):
+        return lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if header.startswith('BZh'):
+        return bz2.BZ2Decompressor
+    return None
+
+
+def zstd_stream(stream):
+    """
+    Wraps binary stream of zstd frames into decompressed one.
+
+    zstd decompression objects neither stop at frame end nor tell where
+    it is (no `unused_data`), they just cannot be used any further, so
+    frames are read across by stream reader instead.
+    """
+    if zstandard is None:
+        raise IOError('zstandard package is required for zstd files')
+    return zstandard.ZstdDecompressor().stream_reader(
+        stream, read_across_frames=True)
+
+
+def decompress_chunks(chunks, new_decompressor):
+    """
+    Decompresses stream of chunks.
+
+    Decompressors stop at the end of gzip member or bzip2 stream, so a
+    new one is started for data following it. This way files
+    concatenated from several compressed parts (e.g. `gzip >> file`) are
+    read whole.
+    """
+    decompressor = new_decompressor()
+    for chunk in chunks:
+        while chunk:
+            try:
+                yield decompressor.decompress(chunk)
+            except EOFError:
+                # bzip2 stream ended exactly at previous chunk boundary
+                decompressor = new_decompressor()
+                continue
+            chunk = getattr(decompressor, 'unused_data', '')
+            if chunk or getattr(decompressor, 'eof', False):
+                decompressor = new_decompressor()
+
+
+def iter_lines(stream, new_decompressor=None, chunk_size=CHUNK_SIZE):
+    """
+    Yields lines from binary stream, decompressing chunks on the fly.
+    """
+    chunks = iter(lambda: stream.read(chunk_size), '')
+    if new_decompressor is not None:
+        chunks = decompress_chunks(chunks, new_decompressor)
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+
+@contextmanager
+def open_data_file(path):
+    """
+    Opens data file for reading line by line.
+
+    Gzip, bzip2 and zstd compressed files are detected by their magic
+    numbers and decompressed while being read, without materialising
+    the whole file.
+    """
+    with open(path, 'rb') as stream:
+        header = stream.read(4)
+        stream.seek(0)
+        if header.startswith(ZSTD_MAGIC):
+            yield iter_lines(zstd_stream(stream))
+        else:
+            yield iter_lines(stream, decompressor_factory(header))
+
+
+def parse_presence(lines):
+    """
+    Parses presence CSV lines into columns.
+
+    Returns dict of columns and list of (line, row, reason) tuples for
+    rows which could not be parsed.
+    """
+    columns = {'line': [], 'user_id': [], 'date': [], 'start': [], 'end': []}
+    rejected = []
+    for i, row in enumerate(csv.reader(lines, delimiter=',')):
+        if not row:
+            continue
+        try:
+            user_id, day, start, end = row
+            user_id = int(user_id)
+            day = datetime.strptime(day, '%Y-%m-%d').date()
+            start = datetime.strptime(start, '%H:%M:%S').time()
+            end = datetime.strptime(end, '%H:%M:%S').time()
+        except (ValueError, TypeError):
+            rejected.append((i, tuple(row), 'malformed'))
+            continue
+        columns['line'].append(i)
+        columns['user_id'].append(user_id)
+        columns['date'].append(day)
+        columns['start'].append(start)
+        columns['end'].append(end)
+    return columns, rejected
+
+
+def validate_presence(columns):
+    """
+    Checks ranges, ordering and duplicates of parsed presence columns.
+
+    All rules are evaluated in a single pass over the rows. Returns list
+    with rejection reason of every row, None for clean rows. Date based
+    rules depend on the current date, so they are checked on merge, see
+    `merge_partitions`.
+    """
+    reasons = []
+    seen = set()
+    rows = izip(
+        columns['user_id'], columns['date'], columns['start'], columns['end'])
+    for row in rows:
+        user_id, _, start, end = row
+        if user_id <= 0:
+            reasons.append('invalid user id')
+        elif end < start:
+            reasons.append('end before start')
+        elif row in seen:
+            reasons.append('duplicate')
+        else:
+            seen.add(row)
+            reasons.append(None)
+    return reasons
+
+
+def quarantine(rejected):
+    """
+    Writes rejected rows with reasons into QUARANTINE_CSV file.
+    """
+    path = app.config.get('QUARANTINE_CSV')
+    if not path:
+        return None
+    with atomic_file(path) as quarantine_file:
+        writer = csv.writer(quarantine_file)
+        writer.writerow([
+            'source', 'line', 'reason', 'user_id', 'date', 'start', 'end'])
+        for source, line, row, reason in rejected:
+            writer.writerow(
+                [source, line + 1, reason] + [str(item) for item in row])
+    return path
+
+
+def load_partition(path):
+    """
+    Parses and validates single presence file.
+
+    Clean rows are kept as arrays of line numbers, user ids, date
+    ordinals and start and end seconds, which is all `merge_partitions`
+    needs, rejected rows as they were parsed. Result is kept until the
+    file changes, so change of one source reloads only its own partition.
+    """
+    signature = file_signature(path)
+    partition = PARTITIONS.get(path)
+    if partition is not None and partition['signature'] == signature:
+        HITS[PARTITIONS_KEY] += 1
+    else:
+        with open_data_file(path) as lines:
+            columns, rejected = parse_presence(lines)
+        partition = dict(
+            (name, array('i'))
+            for name in ('line', 'user_id', 'day', 'start', 'end'))
+        rows = izip(validate_presence(columns), columns['line'],
+                    columns['user_id'], columns['date'],
+                    columns['start'], columns['end'])
+        for reason, line, user_id, day, start, end in rows:
+            if reason is not None:
+                rejected.append((line, (user_id, day, start, end), reason))
+                continue
+            partition['line'].append(line)
+            partition['user_id'].append(user_id)
+            partition['day'].append(day.toordinal())
+            partition['start'].append(seconds_since_midnight(start))
+            partition['end'].append(seconds_since_midnight(end))
+        partition.update({'signature': signature, 'rejected': rejected})
+        PARTITIONS[path] = partition
+    return partition
+
+
+def load_partitions(paths):
+    """
+    Loads partitions of all given files, in parallel for many files.
+
+    Only reading and decompression of files run outside the GIL, CSV
+    parsing does not, so threads help mostly with compressed sources.
+    """
+    for path in set(PARTITIONS) - set(paths):
+        PARTITIONS.pop(path, None)
+    if len(paths) < 2:
+        return map(load_partition, paths)
+    pool = ThreadPool(min(len(paths), app.config.get('DATA_LOAD_THREADS', 4)))
+    try:
+        return pool.map(load_partition, paths)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def merge_partitions(paths):
+    """
+    Merges clean rows of given presence files into sessions of each user.
+
+    Every row is a work session, so there can be many of them per day,
+    also coming from different sources. Overlapping sessions are merged.
+    Rows failing validation, or dated in the future, are written to
+    quarantine file.
+    """
+    today = date.today().toordinal()
+    sessions = {}
+    rejected = []
+    future = []
+    clean = 0
+    for path, partition in zip(paths, load_partitions(paths)):
+        rows = izip(partition['line'], partition['user_id'],
+                    partition['day'], partition['start'], partition['end'])
+        for line, user_id, day, start, end in rows:
+            if day > today:
+                future.append(day)
+                row = (user_id, date.fromordinal(day),
+                       seconds_to_time(start), seconds_to_time(end))
+                rejected.append((path, line, row, 'date in future'))
+                continue
+            clean += 1
+            sessions.setdefault(user_id, []).append((day, start, end))
+        rejected.extend((path, ) + row for row in partition['rejected'])
+    rejected.sort()
+    if rejected:
+        log.warning('%d presence rows rejected.', len(rejected))
+    VALIDATION.clear()
+    VALIDATION.update({
+        'sources': paths,
+        'rows': clean + len(rejected),
+        'clean': clean,
+        'rejected': dict(Counter(row[-1] for row in rejected)),
+        'quarantine': quarantine(rejected),
+        # rows from the future become valid on that day
+        'recheck_on': (
+            date.fromordinal(min(future)).isoformat() if future else None),
+    })
+    return dict(
+        (user_id, UserSessions.from_rows(user_rows))
+        for user_id, user_rows in sessions.iteritems()
+    )
+
+
 @locker
-@memorize_data('user_data', 3600)
+@memorize_data('user_data', 3600, source=lambda: app.config['DATA_CSV'])
 def get_data():
     """
-    Extracts presence data from CSV file and groups it by user_id.
+    Extracts presence data from CSV files and groups it by user_id.
+
+    DATA_CSV is a path, glob pattern or list of them. Files may be gzip,
+    bzip2 or zstd compressed. See `merge_partitions` for merging and
+    validation rules.
+
+    When STORAGE_DIR is configured, data is kept in monthly partition
+    files instead and read-only mapping with the same structure, loading
+    partitions lazily, is returned. CSV files are parsed only when they
+    changed since partitions were built.
 
     It creates structure like this:
     data = {
-        'user_id': {
-            datetime.date(2013, 10, 1): {
-                'start': datetime.time(9, 0, 0),
-                'end': datetime.time(17, 30, 0),
-            },
-            datetime.date(2013, 10, 2): {
-                'start': datetime.time(8, 30, 0),
-                'end': datetime.time(16, 45, 0),
-            },
-        }
+        'user_id': UserSessions(...),
+    }
+    where each UserSessions behaves like dictionary:
+    {
+        datetime.date(2013, 10, 1): {
+            'start': datetime.time(9, 0, 0),
+            'end': datetime.time(17, 30, 0),
+        },
     }
+    with start of the first and end of the last session of each day.
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    paths = data_files(app.config['DATA_CSV'])
+    directory = app.config.get('STORAGE_DIR')
+    if not directory:
+        return merge_partitions(paths)
+
+    budget = app.config.get('STORAGE_MEMORY_BUDGET', 64 * 1024 * 1024)
+    sources = [file_signature(path) for path in paths]
+    store = open_fresh_store(directory, sources, budget)
+    if store is None:
+        # other processes may be building the same store, wait for them
+        with storage.build_lock(directory):
+            store = open_fresh_store(directory, sources, budget)
+            if store is None:
+                data = merge_partitions(paths)
+                store = storage.build_store(
+                    directory, sources, data, budget,
+                    extra={'validation': VALIDATION})
+                # parsed rows live in partition files from now on
+                PARTITIONS.clear()
+                return store
+    VALIDATION.clear()
+    VALIDATION.update(store.manifest['extra'].get('validation', {}))
+    return store
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
-
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
-    return data
 
+def open_fresh_store(directory, sources, budget):
+    """
+    Opens store built from given sources, None when there is none or it
+    holds rows rejected as future which are valid by now.
+    """
+    store = storage.open_store(directory, sources, budget)
+    if store is None:
+        return None
+    recheck_on = store.manifest['extra'].get(
+        'validation', {}).get('recheck_on')
+    if recheck_on and recheck_on <= date.today().isoformat():
+        return None
+    return store
 
+
+@memorize_data(
+    'users_xml', 3600, source=lambda: app.config['USERS_DATA_XML'])
 def parse_user_data_xml():
     """
     Parse and format data from users.xml
     """
     data = []
-    with open('runtime/data/users.xml', 'r') as xmlfile:
+    with open(app.config['USERS_DATA_XML'], 'r') as xmlfile:
         tree = etree.parse(xmlfile)
         server = tree.find('server')
         protocol = server.findtext('protocol')
@@ -144,21 +693,401 @@ def parse_user_data_xml():
     return data
 
 
+@contextmanager
+def atomic_file(path):
+    """
+    Opens temporary file which replaces given path once written.
+
+    Readers never see half-written file, as rename is atomic within
+    the same directory.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    descriptor, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + name)
+    try:
+        with os.fdopen(descriptor, 'w+b') as tmp_file:
+            yield tmp_file
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_import_meta(path):
+    """
+    Reads validators of last import stored next to imported file.
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path + '.meta', 'r') as meta_file:
+            return load(meta_file)
+    except (IOError, ValueError):
+        return {}
+
+
 def import_user_xml_form_url():
     """
     Import and save users.xml form URL
+
+    Feed is streamed into temporary file which atomically replaces
+    USERS_DATA_XML. `If-None-Match` and `If-Modified-Since` headers are
+    sent, so unchanged feed is not downloaded again.
+    Returns True when users.xml was updated.
+    """
+    path = app.config['USERS_DATA_XML']
+    meta = read_import_meta(path)
+    feed_request = urllib2.Request(app.config['USERS_DATA_XML_URL'])
+    if meta.get('etag'):
+        feed_request.add_header('If-None-Match', meta['etag'])
+    if meta.get('last_modified'):
+        feed_request.add_header('If-Modified-Since', meta['last_modified'])
+    try:
+        web_file = urllib2.urlopen(feed_request, timeout=60)
+    except urllib2.HTTPError as error:
+        if error.code == 304:
+            log.debug('Users XML not modified.')
+            return False
+        raise
+    try:
+        with atomic_file(path) as local_file:
+            shutil.copyfileobj(web_file, local_file, CHUNK_SIZE)
+            # refuse to replace users.xml with malformed document
+            local_file.seek(0)
+            etree.parse(local_file)
+        headers = web_file.info()
+        meta = {
+            'etag': headers.getheader('ETag'),
+            'last_modified': headers.getheader(
+                'Last-Modified', formatdate(usegmt=True)),
+        }
+    finally:
+        web_file.close()
+    with atomic_file(path + '.meta') as meta_file:
+        meta_file.write(dumps(meta))
+    purge_cache('users_xml')
+    log.info('Users XML imported to %s.', path)
+    return True
+
+
+def schedule_users_xml_import(interval):
+    """
+    Imports users.xml in background thread every `interval` seconds.
+
+    Returns the importer thread, which stops once its `stop` event is set.
+    """
+    stop = threading.Event()
+
+    def importer():
+        """
+        Import loop, runs until stopped.
+        """
+        while True:
+            try:
+                import_user_xml_form_url()
+            except Exception:  # pylint: disable-msg=W0703
+                log.exception('Users XML import failed.')
+            if stop.wait(interval):
+                return
+
+    thread = threading.Thread(target=importer, name='users-xml-importer')
+    thread.daemon = True
+    thread.stop = stop
+    thread.start()
+    return thread
+
+
+LOADERS[get_data.cache_key] = get_data
+LOADERS[parse_user_data_xml.cache_key] = parse_user_data_xml
+
+
+def deep_size(value, seen=None):
+    """
+    Estimates memory taken by value and everything it references.
+    """
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value, 0)
+    if isinstance(value, dict):
+        size += sum(
+            deep_size(key, seen) + deep_size(item, seen)
+            for key, item in value.iteritems())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in value)
+    elif hasattr(value, '__dict__'):
+        size += deep_size(vars(value), seen)
+    return size
+
+
+def count_rows(data):
+    """
+    Counts rows of loaded data: sessions of presence data, users of
+    users directory.
+    """
+    if isinstance(data, storage.PresenceStore):
+        return sum(
+            month['rows'] for month in data.manifest['months'].values())
+    return sum(
+        len(value.days) if isinstance(value, UserSessions) else 1
+        for value in data.values())
+
+
+def cache_info():
+    """
+    Describes cache entries: approximate size in bytes, age in seconds,
+    hit count and generation.
+
+    Parsed partitions of presence files are listed under PARTITIONS_KEY.
+    """
+    now = time.time()
+    snapshot = []
+    with CACHE_LOCKER:
+        for key, value in CACHE.items():
+            if key in TIMESTAMPS:
+                age = now - TIMESTAMPS[key]
+                generation = GENERATIONS.get(key, 0)
+            else:
+                # results of memorize_generation change in place
+                age = None
+                generation = value['generation']
+                value = OrderedDict(value['results'])
+            snapshot.append((key, value, age, generation))
+        if PARTITIONS:
+            snapshot.append((PARTITIONS_KEY, dict(PARTITIONS), None, None))
+    return [
+        {
+            'key': key,
+            'size': deep_size(value),
+            'age': age,
+            'hits': HITS[key],
+            'generation': generation,
+        }
+        for key, value, age, generation in sorted(snapshot)
+    ]
+
+
+def reload_cache(key):
+    """
+    Reloads data cached under given key in background thread.
+
+    Cached data is served until the new one is loaded. Progress,
+    duration and row count are kept in RELOADS. Returns reload status,
+    None when data under given key cannot be reloaded.
+    """
+    loader = LOADERS.get(key)
+    if loader is None:
+        return None
+    status = RELOADS.get(key)
+    if status is not None and status['state'] == 'running':
+        return status
+    status = RELOADS[key] = {
+        'state': 'running',
+        'started': time.time(),
+        'duration': None,
+        'rows': None,
+        'error': None,
+    }
+
+    def reloader():
+        """
+        Loads data anew, bypassing cache and its lock.
+        """
+        try:
+            rows = count_rows(loader.refresh())
+        except Exception as error:  # pylint: disable-msg=W0703
+            log.exception('Reload of %s failed.', key)
+            status.update({'state': 'failed', 'error': str(error)})
+        else:
+            status.update({'state': 'done', 'rows': rows})
+        status['duration'] = time.time() - status['started']
+
+    thread = threading.Thread(target=reloader, name='reload-' + key)
+    thread.daemon = True
+    thread.start()
+    return status
+
+
+def daily_presence(data, since=None, until=None):
+    """
+    Yields (user_id, date, total seconds of sessions, first start, last
+    end) of every presence day of every user, optionally only of dates
+    between `since` and `until` (inclusive). Days of each user come in
+    chronological order.
+
+    Month partitioned store is scanned month by month, see
+    `PresenceStore.scan`.
+    """
+    if isinstance(data, storage.PresenceStore):
+        users = data.scan(since, until)
+    else:
+        users = ((user_id, data[user_id]) for user_id in data)
+    for user_id, sessions in users:
+        ordinals, offsets = sessions.index()
+        first = bisect_left(ordinals, since.toordinal()) if since else 0
+        last = (bisect_right(ordinals, until.toordinal()) if until
+                else len(ordinals))
+        for i in xrange(first, last):
+            low, high = offsets[i], offsets[i + 1]
+            yield (
+                user_id,
+                date.fromordinal(ordinals[i]),
+                interval(sessions.starts[low:high], sessions.ends[low:high]),
+                sessions.starts[low],
+                sessions.ends[high - 1],
+            )
+
+
+@memorize_generation('rollups', get_data)
+def get_rollups():
+    """
+    Builds per-week, per-month and per-year presence rollups.
+    """
+    rollups = Rollups()
+    for user_id, day, seconds, _, _ in daily_presence(get_data()):
+        rollups.add(user_id, day, seconds)
+    return rollups
+
+
+@memorize_generation('user_aggregates', get_data)
+def get_user_aggregates():
+    """
+    Builds prefix sums of daily presence of every user.
+
+    Returns list indexed by dense user index, None for users without
+    presence data.
+    """
+    data = get_data()
+    REGISTRY.register(data)
+    aggregates = [None] * len(REGISTRY)
+    for user_id, day, seconds, start, end in daily_presence(data):
+        index = REGISTRY.index(user_id)
+        if aggregates[index] is None:
+            aggregates[index] = UserAggregates()
+        aggregates[index].add_day(day, seconds, start, end)
+    return aggregates
+
+
+@memorize_generation('rankings', get_data, maxsize=64)
+def get_ranking_candidates(metric, since=None, until=None, weekday=None):
+    """
+    Returns (value, user_id, days) of given metric of every user present
+    in given dates and weekday.
+
+    Neither order nor limit is an argument, so rankings differing only
+    by them share cached candidates.
+    """
+    aggregates = (
+        (REGISTRY.ids[index], user_aggregates)
+        for index, user_aggregates in enumerate(get_user_aggregates())
+        if user_aggregates is not None
+    )
+    return score(aggregates, metric, since, until, weekday)
+
+
+def get_ranking(metric, limit, largest=True, since=None, until=None,
+                weekday=None):
+    """
+    Returns (user ids, values, days) of `limit` users ranked by given
+    metric.
+    """
+    ranking = rank(
+        get_ranking_candidates(metric, since, until, weekday), limit, largest)
+    return (
+        [user_id for _, user_id, _ in ranking],
+        [value for value, _, _ in ranking],
+        [days for _, _, days in ranking],
+    )
+
+
+@memorize_generation('directory', get_data, parse_user_data_xml)
+def get_directory():
+    """
+    Joins users.xml with presence data by dense user index.
+    """
+    return UserDirectory(REGISTRY, parse_user_data_xml(), get_data())
+
+
+@memorize_generation('weekday_series', get_data)
+def weekday_series(user_id):
     """
-    with open(app.config['USERS_DATA_XML'], 'wb') as local_file:
-        url = app.config['USERS_DATA_XML_URL']
-        web_file = urllib.urlopen("url")
-        local_file.write(web_file.read())
+    Computes all weekday series of given user.
+
+    Series are parallel lists indexed by weekday. Returns None for unknown
+    users.
+    """
+    data = get_data()
+    if user_id not in data:
+        return None
+    weekdays = group_by_weekday(data[user_id])
+    seconds = mean_group_by_weekday_seconds(data[user_id])
+    return OrderedDict([
+        ('weekdays', list(calendar.day_abbr)),
+        ('presence', [sum(weekdays[i]) for i in range(7)]),
+        ('mean', [mean(weekdays[i]) for i in range(7)]),
+        ('start', [mean(seconds[i]['start']) for i in range(7)]),
+        ('end', [mean(seconds[i]['end']) for i in range(7)]),
+    ])
+
+
+@memorize_generation('dashboard', get_data, parse_user_data_xml)
+def user_dashboard(user_id):
+    """
+    Builds user metadata and all weekday series of given user.
+
+    Returns None for unknown users.
+    """
+    series = weekday_series(user_id)
+    if series is None:
+        return None
+    dashboard = {
+        'user': get_directory().user(user_id) or {
+            u'id': user_id,
+            u'name': u'User {}'.format(user_id),
+            u'avatar': None,
+        },
+    }
+    dashboard.update(series)
+    return dashboard
+
+
+def script_json(value):
+    """
+    Serializes value to JSON which is safe to embed in HTML script element.
+    """
+    return dumps(value, separators=(',', ':')).replace('</', '<\\/')
+
+
+@memorize_generation('users_fragment', parse_user_data_xml)
+def users_fragment():
+    """
+    Users listing serialized for embedding in pages.
+    """
+    return script_json(parse_user_data_xml())
+
+
+@memorize_generation('dashboard_fragment', get_data, parse_user_data_xml)
+def dashboard_fragment(user_id):
+    """
+    Dashboard of given user serialized for embedding in pages.
+    """
+    return script_json(user_dashboard(user_id))
 
 
 def group_by_weekday(items):
     """
     Groups presence entries by weekday.
+
+    For sessions, total presence of all sessions of a day is grouped.
     """
     result = {i: [] for i in range(7)}
+    if isinstance(items, UserSessions):
+        for day, low, high in items.daily():
+            result[day.weekday()].append(
+                interval(items.starts[low:high], items.ends[low:high]))
+        return result
     for date in items:
         start = items[date]['start']
         end = items[date]['end']
@@ -169,8 +1098,16 @@ def group_by_weekday(items):
 def mean_group_by_weekday_seconds(items):
     """
     Groups presence entries by weekday with seconds.
+
+    For sessions, start of the first and end of the last session of
+    a day are grouped.
     """
     result = {i: {'start': [], 'end': []} for i in range(7)}
+    if isinstance(items, UserSessions):
+        for day, low, high in items.daily():
+            result[day.weekday()]['start'].append(items.starts[low])
+            result[day.weekday()]['end'].append(items.ends[high - 1])
+        return result
     for date in items:
         start = items[date]['start']
         end = items[date]['end']
@@ -189,8 +1126,13 @@ def seconds_since_midnight(time):
 def interval(start, end):
     """
     Calculates inverval in seconds between two datetime.time objects.
+
+    Given parallel sequences of session starts and ends in seconds since
+    midnight, total length of the sessions is calculated.
     """
-    return seconds_since_midnight(end) - seconds_since_midnight(start)
+    if isinstance(start, datetime_time):
+        return seconds_since_midnight(end) - seconds_since_midnight(start)
+    return sum(end) - sum(start)
 
 
 def mean(items):
@@ -198,3 +1140,37 @@ def mean(items):
     Calculates arithmetic mean. Returns zero for empty lists.
     """
     return float(sum(items)) / len(items) if len(items) > 0 else 0
+
+
+@memorize_generation('norms', get_data)
+def get_norms():
+    """
+    Builds running statistics of presence of every user per weekday.
+    """
+    norms = Norms()
+    for user_id, day, seconds, start, end in daily_presence(get_data()):
+        norms.add(user_id, day, (seconds, start, end))
+    return norms
+
+
+@memorize_generation('anomalies', get_data, maxsize=32)
+def find_anomalies(threshold=3.0, min_days=5, since=None, until=None):
+    """
+    Returns (user ids, dates, metrics, values, means, z-scores) of days
+    between `since` and `until` (inclusive) which are unusual compared
+    with weekday norms of their users.
+    """
+    norms = get_norms()
+    rows = []
+    days = daily_presence(get_data(), since, until)
+    for user_id, day, seconds, start, end in days:
+        for anomaly in norms.check(
+                user_id, day, (seconds, start, end), threshold, min_days):
+            rows.append((user_id, day.isoformat()) + anomaly)
+    # partitioned store yields days month by month
+    rows.sort(key=lambda row: row[:2])
+    columns = [[] for _ in range(6)]
+    for row in rows:
+        for column, value in zip(columns, row):
+            column.append(value)
+    return columns
@@ -2,18 +2,36 @@
 """
 Defines views.
 """
-import calendar
-from flask import redirect, url_for
+import os
+from datetime import datetime
+from werkzeug.security import safe_join
+from flask import abort, redirect, request, url_for
 from flask.ext.mako import render_template, MakoTemplates
 from presence_analyzer.main import app
 from presence_analyzer.utils import (
+    VALIDATION,
+    RELOADS,
+    RANKING_LIMIT,
+    admin_required,
     jsonify,
+    columnar,
     get_data,
-    mean,
-    group_by_weekday,
     parse_user_data_xml,
-    mean_group_by_weekday_seconds
+    user_dashboard,
+    weekday_series,
+    get_rollups,
+    get_ranking,
+    get_directory,
+    memorize_generation,
+    users_fragment,
+    dashboard_fragment,
+    find_anomalies,
+    cache_info,
+    purge_cache,
+    reload_cache,
 )
+from presence_analyzer.rollups import PERIODS, TEAM
+from presence_analyzer.rankings import METRICS
 
 mako = MakoTemplates(app)
 
@@ -30,12 +48,67 @@ def mainpage():
     return redirect(url_for('presence_weekday',))
 
 
+@app.url_defaults
+def static_version(endpoint, values):
+    """
+    Adds modification time of static file to its URL, so it can be cached
+    long and is still refreshed as soon as the file changes.
+    """
+    if endpoint != 'static' or 'v' in values:
+        return
+    path = safe_join(app.static_folder, values.get('filename', ''))
+    if path is not None and os.path.isfile(path):
+        values['v'] = int(os.path.getmtime(path))
+
+
+@app.after_request
+def cache_versioned_static(response):
+    """
+    Lets clients cache versioned static files for STATIC_MAX_AGE.
+    """
+    if request.endpoint == 'static' and 'v' in request.args \
+            and response.status_code == 200:
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config.get(
+            'STATIC_MAX_AGE', 31536000)
+    return response
+
+
+def render_chart(template):
+    """
+    Renders chart page.
+
+    With EMBED_DATA enabled, users list and dashboard of user given in
+    'user_id' query argument are embedded into the page, so browser does
+    not have to fetch them. Such pages are cached per data generation.
+    """
+    if not app.config.get('EMBED_DATA'):
+        return render_template(template, users='null', dashboard='null')
+    user_id = request.args.get('user_id', type=int)
+    if user_id not in get_data():
+        user_id = None
+    return rendered_chart(template, request.script_root, user_id)
+
+
+@memorize_generation('chart_pages', get_data, parse_user_data_xml)
+def rendered_chart(template, script_root, user_id):
+    """
+    Renders chart page with embedded data.
+    """
+    return render_template(
+        template,
+        users=users_fragment(),
+        dashboard=dashboard_fragment(user_id) if user_id is not None
+        else 'null',
+    )
+
+
 @app.route('/chart/presence_weekday')
 def presence_weekday():
     """
     Render presence weekday page.
     """
-    return render_template('presence_weekday.html')
+    return render_chart('presence_weekday.html')
 
 
 @app.route('/chart/mean_time_weekday')
@@ -43,7 +116,7 @@ def mean_time_weekday():
     """
     Render presence mean time page.
     """
-    return render_template('mean_time_weekday.html')
+    return render_chart('mean_time_weekday.html')
 
 
 @app.route('/chart/presence_start_end')
@@ -51,7 +124,7 @@ def presence_start_end():
     """
     Test presence start end page.
     """
-    return render_template('presence_start_end.html')
+    return render_chart('presence_start_end.html')
 
 
 @app.route('/api/v1/users', methods=['GET'])
@@ -70,67 +143,234 @@ def users_view():
 def users_view_xml():
     """
     Users listing with names and avatars for dropdown.
+
+    With 'present' query argument only users having presence data are
+    listed.
     """
+    if request.args.get('present'):
+        return get_directory().listing(present=True)
     return parse_user_data_xml()
 
 
 @app.route('/api/v1/mean_time_weekday/')
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
-@jsonify
+@columnar()
 def mean_time_weekday_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    series = weekday_series(user_id)
+    if series is None:
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], mean(intervals))
-              for weekday, intervals in weekdays.items()]
-
-    return result
+    return [
+        ('weekday', series['weekdays']),
+        ('mean', series['mean']),
+    ]
 
 
 @app.route('/api/v1/presence_weekday/')
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
-@jsonify
+@columnar(header=('Weekday', 'Presence (s)'))
 def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    series = weekday_series(user_id)
+    if series is None:
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], sum(intervals))
-              for weekday, intervals in weekdays.items()]
-
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+    return [
+        ('weekday', series['weekdays']),
+        ('presence', series['presence']),
+    ]
 
 
 @app.route('/api/v1/presence_start_end/')
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
-@jsonify
+@columnar()
 def presence_start_end_view(user_id):
     """
     Returns average time for start and end work
     """
-    data = get_data()
-    if user_id not in data:
+    series = weekday_series(user_id)
+    if series is None:
+        log.debug('User %s not found!', user_id)
+        return []
+
+    return [
+        ('weekday', series['weekdays']),
+        ('start', series['start']),
+        ('end', series['end']),
+    ]
+
+
+@app.route('/api/v2/user/<int:user_id>/dashboard', methods=['GET'])
+@jsonify
+def user_dashboard_view(user_id):
+    """
+    Returns user metadata with all weekday series in one response.
+    """
+    dashboard = user_dashboard(user_id)
+    if dashboard is None:
+        log.debug('User %s not found!', user_id)
+        return {}
+    return dashboard
+
+
+@app.route('/api/admin/validation', methods=['GET'])
+@admin_required
+@jsonify
+def validation_view():
+    """
+    Returns row counts of last presence data validation.
+    """
+    get_data()
+    return VALIDATION
+
+
+@app.route('/api/admin/cache', methods=['GET'])
+@admin_required
+@jsonify
+def cache_view():
+    """
+    Returns cache entries and status of last reloads.
+
+    Note that every worker process keeps its own cache.
+    """
+    return {'entries': cache_info(), 'reloads': RELOADS}
+
+
+@app.route('/api/admin/cache', methods=['DELETE'])
+@admin_required
+@jsonify
+def cache_purge_view():
+    """
+    Removes cache entries given in 'key' query arguments, all entries
+    when there are none. Returns removed keys.
+    """
+    return purge_cache(*request.args.getlist('key'))
+
+
+@app.route('/api/admin/cache/<key>/reload', methods=['POST'])
+@admin_required
+@jsonify
+def cache_reload_view(key):
+    """
+    Starts background reload of data cached under given key.
+    """
+    status = reload_cache(key)
+    if status is None:
+        abort(404)
+    return status
+
+
+@app.route('/api/admin/cache/<key>/reload', methods=['GET'])
+@admin_required
+@jsonify
+def cache_reload_status_view(key):
+    """
+    Returns status of the last reload of data cached under given key.
+    """
+    if key not in RELOADS:
+        abort(404)
+    return RELOADS[key]
+
+
+@app.route('/api/v1/rollup/<period>/team', defaults={'user_id': TEAM})
+@app.route('/api/v1/rollup/<period>/<int:user_id>', methods=['GET'])
+@columnar(header=('Period', 'Presence (s)', 'Days', 'Mean (s)'))
+def rollup_view(period, user_id):
+    """
+    Returns presence totals of given user or whole team per week, month
+    or year.
+    """
+    if period not in PERIODS:
+        abort(404)
+    series = get_rollups().series(period, user_id)
+    if series is None:
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = mean_group_by_weekday_seconds(data[user_id])
+    keys, totals, days, means = series
+    return [
+        ('period', keys),
+        ('presence', totals),
+        ('days', days),
+        ('mean', means),
+    ]
+
+
+def date_args(*names):
+    """
+    Parses YYYY-MM-DD dates from given query arguments, None for missing
+    ones. Raises ValueError for malformed dates.
+    """
+    return [
+        datetime.strptime(request.args[name], '%Y-%m-%d').date()
+        if name in request.args else None
+        for name in names
+    ]
+
+
+@app.route('/api/v1/ranking/<metric>', methods=['GET'])
+@columnar(header=('User', 'Value', 'Days'))
+def ranking_view(metric):
+    """
+    Returns users with most (or least) presence, latest (or earliest)
+    mean arrival or departure.
+
+    Query arguments:
+     - 'order' is 'desc' (default) or 'asc'
+     - 'limit' is number of users, 10 by default
+     - 'since' and 'until' limit dates, formatted as YYYY-MM-DD
+     - 'weekday' limits days to given weekday, 0 is Monday
+    """
+    if metric not in METRICS:
+        abort(404)
+    try:
+        limit = min(int(request.args.get('limit', 10)), RANKING_LIMIT)
+        since, until = date_args('since', 'until')
+        weekday = request.args.get('weekday')
+        weekday = int(weekday) if weekday is not None else None
+    except ValueError:
+        abort(400)
+    if weekday not in (None, 0, 1, 2, 3, 4, 5, 6) or limit < 1:
+        abort(400)
+    largest = request.args.get('order', 'desc') != 'asc'
+
+    user_ids, values, days = get_ranking(
+        metric, limit, largest, since, until, weekday)
+    return [
+        ('user_id', user_ids),
+        ('value', values),
+        ('days', days),
+    ]
+
+
+@app.route('/api/v1/anomalies', methods=['GET'])
+@columnar(header=('User', 'Date', 'Metric', 'Value', 'Mean', 'Z-score'))
+def anomalies_view():
+    """
+    Returns days unusual compared with weekday norms of their users:
+    presence, first arrival or last departure far from the user's mean.
+
+    Query arguments:
+     - 'threshold' is number of standard deviations, 3 by default, rounded
+       to 0.1
+     - 'min_days' is number of days norm has to be built from, 5 by default
+     - 'since' and 'until' limit dates, formatted as YYYY-MM-DD
+    """
+    try:
+        # rounded, so near equal queries share cached results
+        threshold = round(float(request.args.get('threshold', 3)), 1)
+        min_days = min(int(request.args.get('min_days', 5)), 366)
+        since, until = date_args('since', 'until')
+    except ValueError:
+        abort(400)
 
-    result = [(
-              calendar.day_abbr[weekday],
-              mean(average['start']),
-              mean(average['end']))
-              for weekday, average in weekdays.items()
-              ]
-    return result
+    columns = find_anomalies(threshold, max(min_days, 2), since, until)
+    names = ('user_id', 'date', 'metric', 'value', 'mean', 'zscore')
+    return zip(names, columns)